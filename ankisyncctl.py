@@ -4,6 +4,7 @@ import sys
 import getpass
 
 import ankisyncd.config
+from ankisyncd.media_store import get_media_store
 from ankisyncd.users import get_user_manager
 
 
@@ -17,6 +18,8 @@ def usage():
     print("  deluser <username> - delete a user")
     print("  lsuser             - list users")
     print("  passwd <username>  - change password of a user")
+    print("  mediadedup         - link existing media files into the media store")
+    print("  mediagc            - remove unused files from the media store")
 
 def adduser(username):
     password = getpass.getpass("Enter password for {}: ".format(username))
@@ -43,7 +46,7 @@ def lsuser():
 def passwd(username):
     user_manager = get_user_manager(config)
 
-    if username not in user_manager.user_list():
+    if not user_manager.user_exists(username):
         print("User {} doesn't exist".format(username))
         return
 
@@ -53,6 +56,26 @@ def passwd(username):
     except ValueError as error:
         print("Could not set password for user {}: {}".format(username, error), file=sys.stderr)
 
+def _media_store():
+    media_store = get_media_store(config)
+    if media_store is None:
+        print("media_store_path isn't set in the config", file=sys.stderr)
+        exit(1)
+    return media_store
+
+def mediadedup():
+    media_store = _media_store()
+    data_root = os.path.realpath(config['data_root'])
+    for dirname in sorted(os.listdir(data_root)):
+        media_dir = os.path.join(data_root, dirname, "collection.media")
+        if os.path.isdir(media_dir):
+            count = media_store.add_dir(media_dir)
+            print("{}: {} files linked".format(dirname, count))
+
+def mediagc():
+    count = _media_store().gc()
+    print("{} files removed".format(count))
+
 def main():
     argc = len(sys.argv)
 
@@ -61,6 +84,8 @@ def main():
         "deluser": deluser,
         "lsuser": lsuser,
         "passwd": passwd,
+        "mediadedup": mediadedup,
+        "mediagc": mediagc,
     }
 
     if argc < 2:
@@ -2,12 +2,38 @@ import anki
 import anki.storage
 
 import ankisyncd.media
+from ankisyncd.sqlite_profile import get_sqlite_profile
 
 import os, errno
 import logging
+import threading
 
 logger = logging.getLogger("ankisyncd.collection")
 
+# indexes for the "usn >= ?" queries of incremental syncs. Anki creates those
+# of cards, notes and revlog itself, but they may be missing from collections
+# made by other tools.
+USN_INDEXES = (
+    ("ix_cards_usn", "cards"),
+    ("ix_notes_usn", "notes"),
+    ("ix_revlog_usn", "revlog"),
+    ("ix_graves_usn", "graves"),
+)
+# indexes Anki doesn't know about, left out of full downloads
+SERVER_INDEXES = ("ix_graves_usn",)
+
+
+class WrapperCall:
+    """Calls a method of the CollectionWrapper instead of a function on the
+    collection, for managing the collection's lifecycle through any of the
+    wrappers (see CollectionWrapper.replace()). The collection isn't opened
+    for it."""
+
+    def __init__(self, method_name, *args):
+        self.method_name = method_name
+        self.args = args
+        self.__name__ = method_name
+
 
 class CollectionWrapper:
     """A simple wrapper around an anki.storage.Collection object.
@@ -20,10 +46,11 @@ class CollectionWrapper:
     interacting with the collection.
     """
 
-    def __init__(self, _config, path, setup_new_collection=None):
+    def __init__(self, config, path, setup_new_collection=None):
         self.path = os.path.realpath(path)
         self.username = os.path.basename(os.path.dirname(self.path))
         self.setup_new_collection = setup_new_collection
+        self.sqlite_profile = get_sqlite_profile(config)
         self.__col = None
 
     def __del__(self):
@@ -40,14 +67,13 @@ class CollectionWrapper:
         executed some time later and None will be returned.
         """
 
-        # Open the collection and execute the function
-        self.open()
-        args = [self.__col] + args
-        ret = func(*args, **kw)
-        # 上传后需要重新打开，重置col的内存数据
-        if func.__name__ == "operation_upload":
-            self.__col = None
+        if isinstance(func, WrapperCall):
+            ret = getattr(self, func.method_name)(*func.args)
+        else:
+            # Open the collection and execute the function
             self.open()
+            args = [self.__col] + args
+            ret = func(*args, **kw)
         # Only return the value if they requested it, so the interface remains
         # identical between this class and ThreadingCollectionWrapper
         if waitForReturn:
@@ -69,13 +95,25 @@ class CollectionWrapper:
 
     def _get_collection(self):
         col = anki.storage.Collection(self.path)
+        self.sqlite_profile.apply(col.db)
+        self._create_usn_indexes(col)
 
         # Ugly hack, replace default media manager with our custom one
         col.media.close()
-        col.media = ankisyncd.media.ServerMediaManager(col)
+        col.media = ankisyncd.media.ServerMediaManager(col, self.sqlite_profile)
 
         return col
 
+    def _create_usn_indexes(self, col):
+        missing = [(name, table) for name, table in USN_INDEXES
+                   if not col.db.scalar("select 1 from sqlite_master where type = 'index' and name = ?", name)]
+        if not missing:
+            return
+        for name, table in missing:
+            logger.info("Creating index %s in %s", name, self.path)
+            col.db.execute("create index if not exists %s on %s (usn)" % (name, table))
+        col.db.commit()
+
     def open(self):
         """Open the collection, or create it if it doesn't exist."""
         if self.__col is None:
@@ -89,13 +127,46 @@ class CollectionWrapper:
         if not self.opened():
             return
 
-        self.__col.close()
+        if getattr(self.__col, 'sync_transaction', None) is not None:
+            # an incremental sync which hasn't finished, see
+            # SyncCollectionHandler, its changes are thrown away
+            logger.warning("Closing %s during a sync, rolling the sync back", self.path)
+            self.__col.close(save=False)
+        else:
+            self.__col.close()
         self.__col = None
 
+    def replace(self, path):
+        """Replaces the collection file by the one at path, e.g. after a full
+        upload. The collection is closed, the new one is only opened once
+        it's used."""
+        self.close()
+        os.replace(path, self.path)
+
     def opened(self):
         """Returns True if the collection is open, False otherwise."""
         return self.__col is not None
 
+    def sync_in_progress(self):
+        """Returns True if the changes of an incremental sync, which hasn't
+        timed out, are kept in an uncommitted transaction (see
+        SyncCollectionHandler). Closing the collection would roll it back."""
+        sync = getattr(self.__col, 'sync_transaction', None)
+        return sync is not None and not sync.expired()
+
+    def syncing(self):
+        """Returns True if an incremental sync of the collection has started,
+        but not finished yet."""
+        return getattr(self.__col, 'sync_handler', None) is not None
+
+    def checkpoint(self):
+        """Checkpoints the databases of the collection if it's open and they
+        are in WAL mode."""
+        if not self.opened():
+            return
+        self.sqlite_profile.checkpoint(self.__col.db)
+        self.sqlite_profile.checkpoint(self.__col.media.db)
+
 class CollectionManager:
     """Manages a set of CollectionWrapper objects."""
 
@@ -104,16 +175,20 @@ class CollectionManager:
     def __init__(self, config):
         self.collections = {}
         self.config = config
+        # requests are handled by multiple threads, make sure they don't
+        # create more than one wrapper for the same collection
+        self._lock = threading.Lock()
 
     def get_collection(self, path, setup_new_collection=None):
         """Gets a CollectionWrapper for the given path."""
 
         path = os.path.realpath(path)
 
-        try:
-            col = self.collections[path]
-        except KeyError:
-            col = self.collections[path] = self.collection_wrapper(self.config, path, setup_new_collection)
+        with self._lock:
+            try:
+                col = self.collections[path]
+            except KeyError:
+                col = self.collections[path] = self.collection_wrapper(self.config, path, setup_new_collection)
 
         return col
 
@@ -1,48 +1,149 @@
 # -*- coding: utf-8 -*-
 
+import glob
+import io
+import logging
 import os
+import tempfile
+import uuid
 from sqlite3 import dbapi2 as sqlite
 
+from webob import Response
+from webob.exc import HTTPBadRequest
+
 import anki.db
-from  ankisyncd.collection import CollectionWrapper
+from  ankisyncd.collection import CollectionWrapper, SERVER_INDEXES
+
+logger = logging.getLogger("ankisyncd.full_sync")
+
+
+class SnapshotFileIter:
+    """A WSGI app_iter which streams a collection snapshot in fixed-size chunks
+    and removes the snapshot file once the response is finished."""
+
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.file = open(path, 'rb')
+
+    def __iter__(self):
+        return iter(lambda: self.file.read(self.chunk_size), b'')
+
+    def close(self):
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
 
 class FullSyncManager:
-    def upload(self, col, data, session):
-        # Verify integrity of the received database file before replacing our
-        # existing db.
-        temp_db_path = session.get_collection_path() + ".tmp"
-        with open(temp_db_path, 'wb') as f:
-            f.write(data)
+    # size of the chunks the collection is sent to the client in
+    download_chunk_size = 64 * 1024
+    # size of the chunks an uploaded collection is written to disk in
+    upload_chunk_size = 64 * 1024
+    # "integrity_check" verifies the whole database, "quick_check" skips the
+    # slow index consistency checks
+    integrity_check = "integrity_check"
 
+    def __init__(self, config=None):
+        if config and config.get("full_sync_integrity_check"):
+            self.integrity_check = config["full_sync_integrity_check"]
+        if self.integrity_check not in ("integrity_check", "quick_check"):
+            raise ValueError("Unsupported full_sync_integrity_check: {}"
+                             .format(self.integrity_check))
+
+    def upload(self, wrapper, data, session):
+        """Replaces the collection of the session's collection wrapper by an
+        uploaded one."""
+        temp_db_path = self.receive(data, session)
         try:
-            with anki.db.DB(temp_db_path) as test_db:
-                if test_db.scalar("pragma integrity_check") != "ok":
-                    raise HTTPBadRequest("Integrity check failed for uploaded "
-                                         "collection database file.")
-        except sqlite.Error as e:
-            raise HTTPBadRequest("Uploaded collection database file is "
-                                 "corrupt.")
-
-        # Overwrite existing db.
-        col.close()
-        # try:
-        #     os.replace(temp_db_path, session.get_collection_path())
-        # finally:
-        #     col.reopen()
-        #     col.load()
-        os.replace(temp_db_path, session.get_collection_path())
+            wrapper.replace(temp_db_path)
+        finally:
+            if os.path.exists(temp_db_path):
+                os.unlink(temp_db_path)
         return "OK"
 
+    def receive(self, data, session):
+        """Writes an uploaded collection to a temporary file next to the
+        user's collection, verifies its integrity and returns its path. This
+        doesn't need the collection, so it's done before the collection's
+        thread is involved."""
+
+        # data is usually a (possibly gzip-decompressing) file object reading
+        # the request body, bytes are accepted for backwards compatibility
+        if isinstance(data, bytes):
+            data = io.BytesIO(data)
+
+        # unique, uploads for the same collection may be received at the same
+        # time
+        temp_db_path = "%s.%s.tmp" % (session.get_collection_path(), uuid.uuid4().hex)
+        try:
+            size = 0
+            with open(temp_db_path, 'xb') as f:
+                for chunk in iter(lambda: data.read(self.upload_chunk_size), b''):
+                    f.write(chunk)
+                    size += len(chunk)
+            logger.info("Received collection upload for %s: %d bytes", session.name, size)
+
+            try:
+                with anki.db.DB(temp_db_path) as test_db:
+                    if test_db.scalar("pragma %s" % self.integrity_check) != "ok":
+                        raise HTTPBadRequest("Integrity check failed for uploaded "
+                                             "collection database file.")
+            except sqlite.Error as e:
+                raise HTTPBadRequest("Uploaded collection database file is "
+                                     "corrupt.")
+        except Exception:
+            if os.path.exists(temp_db_path):
+                os.unlink(temp_db_path)
+            raise
+
+        return temp_db_path
+
 
     def download(self, col, session):
-        # col.close()
-        # try:
-        #     data = open(session.get_collection_path(), 'rb').read()
-        # finally:
-        #     col.open()
-        #     col.load()
-        data = open(session.get_collection_path(), 'rb').read()
-        return data
+        # Copy the last committed state of the collection to a temporary file
+        # using SQLite's backup API, so that the client gets a consistent
+        # snapshot even if the collection changes while the response is still
+        # being sent. The snapshot is streamed from disk, so memory usage
+        # doesn't depend on the size of the collection.
+        col_path = session.get_collection_path()
+        fd, snapshot_path = tempfile.mkstemp(dir=os.path.dirname(col_path),
+                                             suffix=".download")
+        os.close(fd)
+
+        try:
+            src = sqlite.connect(col_path)
+            dst = sqlite.connect(snapshot_path)
+            try:
+                src.backup(dst)
+                # the collection may be in WAL mode, the client gets a
+                # self-contained file
+                dst.execute("pragma journal_mode = delete")
+                for name in SERVER_INDEXES:
+                    dst.execute("drop index if exists %s" % name)
+            finally:
+                dst.close()
+                src.close()
+
+            size = os.path.getsize(snapshot_path)
+            app_iter = SnapshotFileIter(snapshot_path, self.download_chunk_size)
+        except Exception:
+            os.unlink(snapshot_path)
+            raise
+
+        return Response(app_iter=app_iter, content_length=size)
+
+    def remove_stale_snapshots(self, data_root):
+        """Removes the snapshots of downloads which were still being sent when
+        the server was stopped."""
+        for path in glob.glob(os.path.join(glob.escape(data_root), "*", "*.download")):
+            logger.info("Removing stale download snapshot %s", path)
+            try:
+                os.unlink(path)
+            except OSError as e:
+                logger.warning("Unable to remove %s: %s", path, e)
 
 
 def get_full_sync_manager(config):
@@ -58,4 +159,4 @@ def get_full_sync_manager(config):
                             inherit from FullSyncManager''')
         return class_(config)
     else:
-        return FullSyncManager()
+        return FullSyncManager(config)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import logging
+import random
+import re
+import uuid
+
+FORMAT = "[%(asctime)s]:%(levelname)s:%(name)s:%(request_id)s:%(message)s"
+
+# correlation ID of the request being handled, included in every log message
+request_id = contextvars.ContextVar("request_id", default="-")
+# IDs passed by a proxy in the X-Request-Id header are used if they look sane
+_valid_request_id = re.compile(r"[A-Za-z0-9._-]{1,64}\Z")
+# whether the payloads of the current request are logged
+_payload_sampled = contextvars.ContextVar("payload_sampled", default=True)
+
+# set by configure()
+payload_max_length = 1000
+payload_sample_rate = 1.0
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class LazyRepr:
+    """Formats an object with repr() only if the log message it's an argument
+    of is emitted, shortened to payload_max_length characters."""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        s = repr(self.obj)
+        if payload_max_length and len(s) > payload_max_length:
+            return "%s... (%d characters)" % (s[:payload_max_length], len(s))
+        return s
+
+
+def start_request(rid=None):
+    """Sets the correlation ID of the request handled in the current context,
+    generating one unless given, and decides if its payloads are logged.
+    Returns the ID."""
+    if not rid or not _valid_request_id.match(rid):
+        rid = uuid.uuid4().hex[:12]
+    request_id.set(rid)
+    _payload_sampled.set(payload_sample_rate >= 1 or random.random() < payload_sample_rate)
+    return rid
+
+
+def request_state():
+    """Returns what start_request() set, for handing it over to another
+    process."""
+    return request_id.get(), _payload_sampled.get()
+
+
+def restore_request(state):
+    rid, sampled = state
+    request_id.set(rid)
+    _payload_sampled.set(sampled)
+
+
+def debug_payload(logger, msg, *args):
+    """Logs msg at DEBUG level for the requests which are sampled, with args
+    formatted by LazyRepr. Costs next to nothing when DEBUG is disabled."""
+    if logger.isEnabledFor(logging.DEBUG) and _payload_sampled.get():
+        logger.debug(msg, *[LazyRepr(arg) for arg in args])
+
+
+def setup(level=logging.INFO):
+    """Configures the root logger to include request IDs."""
+    logging.basicConfig(level=level, format=FORMAT)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
+
+
+def configure(config):
+    """Applies the logging settings of the config."""
+    global payload_max_length, payload_sample_rate
+    payload_max_length = int(config.get('log_payload_max_length', 1000))
+    payload_sample_rate = float(config.get('log_payload_sample_rate', 1))
+    logging.getLogger().setLevel(config.get('log_level', 'INFO').upper())
@@ -13,8 +13,9 @@ logger = logging.getLogger("ankisyncd.media")
 
 
 class ServerMediaManager:
-    def __init__(self, col):
+    def __init__(self, col, sqlite_profile=None):
         self._dir = re.sub(r"(?i)\.(anki2)$", ".media", col.path)
+        self.sqlite_profile = sqlite_profile
         self.connect()
 
     def connect(self):
@@ -40,28 +41,127 @@ class ServerMediaManager:
                 self.db.commit()
                 self.db.execute("DETACH old")
 
+        # REPLACE only fires the delete triggers below with this enabled
+        self.db.execute("PRAGMA recursive_triggers = ON")
+        if not self.db.scalar("SELECT 1 FROM sqlite_master WHERE name = 'meta'"):
+            self._createMeta()
+        if self.sqlite_profile is not None:
+            self.sqlite_profile.apply(self.db)
+
+        self._loadUsn()
+
+    def _createMeta(self):
+        # number of files which aren't deleted, kept up to date by triggers so
+        # that mediaCount() doesn't have to scan the whole table
+        self.db.executescript(
+            """CREATE TABLE meta (live INT NOT NULL);
+            INSERT INTO meta SELECT count() FROM media WHERE csum IS NOT NULL;
+            CREATE TRIGGER media_live_insert AFTER INSERT ON media
+                WHEN new.csum IS NOT NULL
+                BEGIN UPDATE meta SET live = live + 1; END;
+            CREATE TRIGGER media_live_delete AFTER DELETE ON media
+                WHEN old.csum IS NOT NULL
+                BEGIN UPDATE meta SET live = live - 1; END;
+            CREATE TRIGGER media_live_update AFTER UPDATE OF csum ON media
+                WHEN (old.csum IS NULL) != (new.csum IS NULL)
+                BEGIN UPDATE meta SET live = live + (new.csum IS NOT NULL) - (old.csum IS NOT NULL); END;"""
+        )
+        self.db.commit()
+
+    def _loadUsn(self):
+        # lastUsn() is needed by most media sync operations, so the counter is
+        # kept in memory, along with the number of changes made through our
+        # connection at the time, to notice writes which bypass syncAdd() and
+        # syncDelete()
+        self._usn = self.db.scalar("SELECT max(usn) FROM media") or 0
+        self._usnChanges = self.db._db.total_changes
+
     def close(self):
         self.db.close()
 
+    def rollback(self):
+        """Rolls back the media database. The USN counter is reloaded, USNs
+        handed out by the rolled back changes would be skipped otherwise."""
+        self.db.rollback()
+        self._loadUsn()
+
     def dir(self):
         return self._dir
 
     def lastUsn(self):
-        return self.db.scalar("SELECT max(usn) FROM media") or 0
+        if self.db._db.total_changes != self._usnChanges:
+            self._loadUsn()
+        return self._usn
 
     def mediaCount(self):
-        return self.db.scalar("SELECT count() FROM media WHERE csum IS NOT NULL")
+        return self.db.scalar("SELECT live FROM meta")
 
     # used only in unit tests
     def syncInfo(self, fname):
         return self.db.first("SELECT csum, 0 FROM media WHERE fname=?", fname)
 
+    def syncAdd(self, files):
+        """Records files, a list of (fname, csum) tuples, as added or changed,
+        assigning them consecutive USNs. The caller has to commit."""
+        usn = self.lastUsn()
+        rows = []
+        for fname, csum in files:
+            usn += 1
+            rows.append((fname, usn, csum))
+
+        self.db.executemany("INSERT OR REPLACE INTO media VALUES (?,?,?)", rows)
+        self._usn = usn
+        self._usnChanges = self.db._db.total_changes
+
     def syncDelete(self, fname):
         fpath = os.path.join(self.dir(), fname)
         if os.path.exists(fpath):
             os.remove(fpath)
-        self.db.execute(
+        usn = self.lastUsn() + 1
+        cur = self.db.execute(
             "UPDATE media SET csum = NULL, usn = ? WHERE fname = ?",
-            self.lastUsn() + 1,
+            usn,
             fname,
         )
+        # the USN is only used up if we knew about the file
+        if cur.rowcount:
+            self._usn = usn
+        self._usnChanges = self.db._db.total_changes
+
+    def syncDeleteMany(self, fnames):
+        """Marks all files in fnames as deleted in a single transaction, which
+        is committed, and removes them from the media directory afterwards."""
+        known = set()
+        # stay below SQLite's limit on the number of host parameters
+        for i in range(0, len(fnames), 500):
+            batch = fnames[i:i + 500]
+            known.update(self.db.list(
+                "SELECT fname FROM media WHERE fname IN (%s)" % ",".join("?" * len(batch)),
+                *batch
+            ))
+
+        # like with syncDelete(), only files we know about use up a USN
+        usn = self.lastUsn()
+        rows = []
+        for fname in fnames:
+            if fname in known:
+                usn += 1
+                rows.append((usn, fname))
+
+        try:
+            self.db.executemany("UPDATE media SET csum = NULL, usn = ? WHERE fname = ?", rows)
+            self.db.commit()
+        except Exception:
+            self.rollback()
+            raise
+        self._usn = usn
+        self._usnChanges = self.db._db.total_changes
+
+        for fname in fnames:
+            try:
+                os.remove(os.path.join(self.dir(), fname))
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                logger.error("Error when removing file '%s' from media dir: "
+                             "%s" % (fname, str(err)))
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import os
+import struct
+import threading
+import uuid
+import zlib
+
+logger = logging.getLogger("ankisyncd.media_cache")
+
+# CRC-32 and uncompressed size of the file, followed by the raw deflate stream
+_HEADER = struct.Struct("<IQ")
+
+
+class CachedBlob:
+    """A media file deflated ahead of time, ready to be copied into a zip file
+    as it is. data is positioned at the start of the deflate stream."""
+
+    def __init__(self, data, crc, file_size, compress_size):
+        self.data = data
+        self.crc = crc
+        self.file_size = file_size
+        self.compress_size = compress_size
+
+
+class MediaBlobCache:
+    """An on-disk cache of deflated media files, shared by all users, keyed by
+    the checksum of their contents from the media database. When the total
+    size goes over max_size, the least recently used blobs are removed."""
+
+    def __init__(self, path, max_size):
+        self.path = os.path.realpath(path)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # csum -> size, LRU first
+        self._size = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name.startswith("."):
+                    # left behind by an interrupted put()
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+                found.append((st.st_mtime, name, st.st_size))
+
+        for mtime, csum, size in sorted(found):
+            self._entries[csum] = size
+            self._size += size
+        logger.info("Media cache at %s holds %d files, %d bytes",
+                    self.path, len(self._entries), self._size)
+        self._evict()
+
+    def _blob_path(self, csum):
+        return os.path.join(self.path, csum[:2], csum)
+
+    def get(self, csum):
+        """Returns a CachedBlob for the file with the given checksum, or None
+        if it isn't cached. The caller has to close its data."""
+        with self._lock:
+            if csum not in self._entries:
+                return None
+            try:
+                f = open(self._blob_path(csum), "rb")
+            except FileNotFoundError:
+                self._size -= self._entries.pop(csum)
+                return None
+            self._entries.move_to_end(csum)
+
+        try:
+            os.utime(f.fileno())
+            crc, file_size = _HEADER.unpack(f.read(_HEADER.size))
+            compress_size = os.fstat(f.fileno()).st_size - _HEADER.size
+        except Exception:
+            f.close()
+            raise
+        return CachedBlob(f, crc, file_size, compress_size)
+
+    def put(self, csum, src, compresslevel=None, chunk_size=64*1024):
+        """Deflates the file object src into the cache under the given
+        checksum and returns it like get() does. The blob is returned even if
+        it's evicted right away, e.g. because it's larger than the cache."""
+        if compresslevel is None:
+            compresslevel = zlib.Z_DEFAULT_COMPRESSION
+        path = self._blob_path(csum)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(path), ".%s" % uuid.uuid4().hex)
+
+        try:
+            with open(tmp, "xb") as f:
+                f.write(_HEADER.pack(0, 0))
+                compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+                crc = 0
+                file_size = 0
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    crc = zlib.crc32(chunk, crc)
+                    file_size += len(chunk)
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+                size = f.tell()
+                f.seek(0)
+                f.write(_HEADER.pack(crc, file_size))
+            os.replace(tmp, path)
+            # opened before it can be evicted, the data stays readable
+            blob = open(path, "rb")
+            blob.seek(_HEADER.size)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            self._size += size - self._entries.pop(csum, 0)
+            self._entries[csum] = size
+            self._evict()
+
+        return CachedBlob(blob, crc, file_size, size - _HEADER.size)
+
+    def _evict(self):
+        while self._size > self.max_size and self._entries:
+            csum, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._blob_path(csum))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # e.g. still open on Windows
+                logger.warning("Couldn't remove media cache file %s: %s", csum, e)
+
+
+# For working with the global MediaBlobCache:
+
+media_cache = None
+_media_cache_lock = threading.Lock()
+
+def get_media_cache(config):
+    """Return the global MediaBlobCache for this process, or None if the
+    cache isn't enabled in the config."""
+    global media_cache
+    if not config or not config.get('media_cache_path'):
+        return None
+    with _media_cache_lock:
+        if media_cache is None:
+            media_cache = MediaBlobCache(
+                config['media_cache_path'],
+                int(config.get('media_cache_size', 1024)) * 1024 * 1024,
+            )
+    return media_cache
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import errno
+import hashlib
+import logging
+import os
+import threading
+import uuid
+
+logger = logging.getLogger("ankisyncd.media_store")
+
+
+class MediaBlobStore:
+    """Deduplicates media files across users by keeping a single copy of each
+    distinct file in a shared directory, named after its sha1 checksum, which
+    the files in the media directories of the users are hard links to.
+
+    The number of links to a blob serves as its reference count: when no
+    media directory refers to it anymore, it's removed by gc(). The store has
+    to be on the same filesystem as the collections, otherwise every user
+    keeps their own copy, as if the store wasn't used."""
+
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        self._warned = False
+        os.makedirs(self.path, exist_ok=True)
+
+    def _blob_path(self, csum):
+        return os.path.join(self.path, csum[:2], csum)
+
+    def add(self, path, csum):
+        """Turns the media file at path, whose contents have the given sha1
+        checksum, into a link to the shared copy, making it the shared copy if
+        there's none yet. Returns False if the file couldn't be linked."""
+        blob = self._blob_path(csum)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+
+        # The blob may disappear between the two attempts if gc() runs at the
+        # same time, in which case we try again.
+        for attempt in range(3):
+            try:
+                os.link(path, blob)
+                return True
+            except FileExistsError:
+                pass
+            except OSError as err:
+                return self._link_failed(err)
+
+            tmp = os.path.join(os.path.dirname(path), ".link-" + uuid.uuid4().hex)
+            try:
+                os.link(blob, tmp)
+            except FileNotFoundError:
+                continue
+            except OSError as err:
+                return self._link_failed(err)
+            os.replace(tmp, path)
+            return True
+
+        return False
+
+    def _link_failed(self, err):
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise err
+        if not self._warned:
+            logger.warning("Couldn't link media files into %s, they won't be "
+                           "deduplicated: %s", self.path, err)
+            self._warned = True
+        return False
+
+    def add_dir(self, media_dir):
+        """Links all files already in media_dir into the store. Returns the
+        number of files which weren't linked before."""
+        count = 0
+        with os.scandir(media_dir) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                if entry.stat().st_nlink > 1:
+                    continue
+
+                sha1 = hashlib.sha1()
+                with open(entry.path, "rb") as f:
+                    for chunk in iter(lambda: f.read(64*1024), b""):
+                        sha1.update(chunk)
+                if self.add(entry.path, sha1.hexdigest()):
+                    count += 1
+        return count
+
+    def gc(self):
+        """Removes blobs none of the media directories refer to anymore.
+        Returns the number of removed blobs."""
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                        count += 1
+                except FileNotFoundError:
+                    pass
+        logger.info("Removed %d unused media files from %s", count, self.path)
+        return count
+
+
+# For working with the global MediaBlobStore:
+
+media_store = None
+_media_store_lock = threading.Lock()
+
+def get_media_store(config):
+    """Return the global MediaBlobStore for this process, or None if it isn't
+    enabled in the config."""
+    global media_store
+    if not config or not config.get('media_store_path'):
+        return None
+    with _media_store_lock:
+        if media_store is None:
+            media_store = MediaBlobStore(config['media_store_path'])
+    return media_store
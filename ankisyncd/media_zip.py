@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import time
+import zipfile
+
+logger = logging.getLogger("ankisyncd.media_zip")
+
+
+# Formats which are compressed already and don't get any smaller when
+# deflated. Most media files in Anki collections are one of these.
+STORED_EXTENSIONS = {
+    ".aac", ".avif", ".flac", ".gif", ".gz", ".heic", ".jpeg", ".jpg", ".m4a",
+    ".m4v", ".mkv", ".mov", ".mp3", ".mp4", ".oga", ".ogg", ".ogv", ".opus",
+    ".png", ".webm", ".webp", ".zip",
+}
+
+# (offset, signature) of the same kind of formats, for files with unknown or
+# misleading extensions
+STORED_SIGNATURES = [
+    (0, b"\xff\xd8\xff"),         # JPEG
+    (0, b"\x89PNG\r\n\x1a\n"),    # PNG
+    (0, b"GIF8"),                 # GIF
+    (0, b"OggS"),                 # Ogg (Vorbis, Opus, Theora)
+    (0, b"fLaC"),                 # FLAC
+    (0, b"ID3"),                  # MP3 with ID3v2 tag
+    (0, b"\xff\xfb"),             # MP3 frame
+    (0, b"\xff\xf3"),             # MP3 frame
+    (0, b"\xff\xf2"),             # MP3 frame
+    (0, b"\xff\xf1"),             # AAC ADTS
+    (0, b"\xff\xf9"),             # AAC ADTS
+    (0, b"\x1a\x45\xdf\xa3"),     # Matroska, WebM
+    (4, b"ftyp"),                 # MP4, M4A, MOV, HEIC, AVIF
+    (8, b"WEBP"),                 # WebP (RIFF container)
+    (0, b"PK\x03\x04"),           # zip
+    (0, b"\x1f\x8b"),             # gzip
+]
+
+SNIFF_SIZE = 16
+
+
+def compress_type(filename, head=b""):
+    """Returns the compression method to use for a media file, given its name
+    and its first SNIFF_SIZE bytes: ZIP_STORED for formats which are already
+    compressed, ZIP_DEFLATED for everything else."""
+
+    if os.path.splitext(filename)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    for offset, signature in STORED_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+class _ZipBuffer:
+    """A write-only file object which collects whatever zipfile writes to it
+    until it's taken out to be sent to the client. Not being seekable makes
+    zipfile write sizes and checksums after the data of each member."""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def _splice(z, buf, name, blob, chunk_size):
+    """Adds a member which was deflated beforehand to the ZipFile z, copying
+    the compressed data as it is. Yields chunks of the output like
+    stream_zip() does."""
+
+    zinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    zinfo.CRC = blob.crc
+    zinfo.file_size = blob.file_size
+    zinfo.compress_size = blob.compress_size
+
+    # what ZipFile.open() does for a new member, except that the sizes are
+    # known up front, so they're written in the header
+    zinfo.header_offset = z.fp.tell()
+    z.fp.write(zinfo.FileHeader())
+    with blob.data:
+        for chunk in iter(lambda: blob.data.read(chunk_size), b''):
+            z.fp.write(chunk)
+            if buf.size >= chunk_size:
+                yield buf.take()
+    z.start_dir = z.fp.tell()
+    z.filelist.append(zinfo)
+    z.NameToInfo[name] = zinfo
+
+
+def _cached(cache, csum, data, compresslevel):
+    """Returns the cached blob for the file, deflating data into the cache
+    first if needed. Returns None if that fails, with data rewound."""
+    try:
+        blob = cache.get(csum) or cache.put(csum, data, compresslevel)
+        if blob is not None:
+            return blob
+    except OSError:
+        logger.exception("Couldn't cache media file %s", csum)
+    # put() may have read some or all of it
+    data.seek(0)
+    return None
+
+
+class ZipStream:
+    """The response body returned by stream_zip(). Closing it closes the files
+    among the members, even if it hasn't been iterated over, e.g. because the
+    client went away before the response was started."""
+
+    def __init__(self, members, generator):
+        self.members = members
+        self._generator = generator
+
+    def __iter__(self):
+        return self._generator
+
+    def close(self):
+        try:
+            self._generator.close()
+        finally:
+            _close_members(self.members)
+
+
+def _close_members(members):
+    for name, data, size, compress_type, csum in members:
+        if not isinstance(data, bytes):
+            data.close()
+
+
+def stream_zip(members, compresslevel=None, cache=None, chunk_size=64*1024):
+    """Returns an iterable generating a zip file chunk by chunk, so that it
+    can be sent to the client while it's being compressed.
+
+    members is a list of (name, data, size, compress_type, csum) tuples, where
+    data is either bytes or a file object opened in binary mode, which is read
+    in chunks of chunk_size bytes and closed when it's no longer needed, or
+    when the iterable is closed. compresslevel is used for deflated members.
+    If a MediaBlobCache is given, deflated files with a csum are taken from
+    it instead of being compressed again."""
+
+    return ZipStream(members, _generate_zip(members, compresslevel, cache, chunk_size))
+
+
+def _generate_zip(members, compresslevel, cache, chunk_size):
+    buf = _ZipBuffer()
+    try:
+        with zipfile.ZipFile(buf, "w", compresslevel=compresslevel) as z:
+            for name, data, size, compress_type, csum in members:
+                if (cache is not None and csum is not None and
+                        compress_type == zipfile.ZIP_DEFLATED and
+                        not isinstance(data, bytes)):
+                    blob = _cached(cache, csum, data, compresslevel)
+                    if blob is not None:
+                        data.close()
+                        yield from _splice(z, buf, name, blob, chunk_size)
+                        continue
+
+                # picked up by ZipFile.open() for the new member
+                z.compression = compress_type
+                force_zip64 = size * 1.05 > zipfile.ZIP64_LIMIT
+
+                with z.open(name, "w", force_zip64=force_zip64) as dst:
+                    if isinstance(data, bytes):
+                        dst.write(data)
+                    else:
+                        with data:
+                            for chunk in iter(lambda: data.read(chunk_size), b''):
+                                dst.write(chunk)
+                                if buf.size >= chunk_size:
+                                    yield buf.take()
+
+                if buf.size >= chunk_size:
+                    yield buf.take()
+
+        yield buf.take()
+    finally:
+        # close the files we didn't get to
+        _close_members(members)
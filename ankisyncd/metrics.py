@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+import time
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, label="operation"):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._lock = threading.Lock()
+
+    def _labels(self, value, **extra):
+        # several labels are given as tuples of names and values
+        if isinstance(self.label, tuple):
+            labels = dict(zip(self.label, value))
+        else:
+            labels = {self.label: value} if self.label else {}
+        labels.update(extra)
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels.items())
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, help, label="operation"):
+        Metric.__init__(self, name, help, label)
+        self._values = {}
+
+    def inc(self, label=None, amount=1):
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ["%s%s %s" % (self.name, self._labels(k), _format(v)) for k, v in values]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, label="operation", buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, label)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._values = {}  # label -> [bucket counts, sum]
+
+    def observe(self, label, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(label) or ([0] * len(self.buckets), 0)
+            counts[i] += 1
+            self._values[label] = counts, total + value
+
+    def time(self, label):
+        return _Timer(self, label)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, list(counts), total) for k, (counts, total) in self._values.items())
+
+        lines = []
+        for label, counts, total in values:
+            cumulative = 0
+            for le, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name, self._labels(label, le=_format(le)), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, self._labels(label), _format(total)))
+            lines.append("%s_count%s %d" % (self.name, self._labels(label), cumulative))
+        return lines
+
+
+class Gauge(Metric):
+    """A value computed when the metrics are collected."""
+    type = "gauge"
+
+    def __init__(self, name, help, func):
+        Metric.__init__(self, name, help, label=None)
+        self.func = func
+
+    def samples(self):
+        return ["%s %s" % (self.name, _format(self.func()))]
+
+
+class _Timer:
+    def __init__(self, histogram, label):
+        self.histogram = histogram
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(self.label, time.monotonic() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Adds a metric, replacing any previous one of the same name."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.register(Histogram(
+    "ankisyncd_request_duration_seconds",
+    "Time spent handling sync requests, including sending the response."))
+request_bytes = registry.register(Counter(
+    "ankisyncd_request_bytes_total", "Size of sync request bodies."))
+response_bytes = registry.register(Counter(
+    "ankisyncd_response_bytes_total", "Size of sync response bodies."))
+requests_total = registry.register(Counter(
+    "ankisyncd_requests_total", "Sync requests handled, by response status.",
+    label=("operation", "status")))
+queue_seconds = registry.register(Histogram(
+    "ankisyncd_collection_queue_seconds",
+    "Time calls waited for their collection's thread."))
+execute_seconds = registry.register(Histogram(
+    "ankisyncd_collection_execute_seconds",
+    "Time spent running calls on collections."))
+
+
+def _record(operation, status, start):
+    requests_total.inc((operation, status))
+    request_seconds.observe(operation, time.monotonic() - start)
+
+
+def _is_open(col):
+    """Returns False for collection wrappers which have been evicted, or whose
+    collection isn't open."""
+    if hasattr(col, "evicted"):
+        return not col.evicted
+    if hasattr(col, "opened"):
+        return col.opened()
+    # process proxies are forgotten once their collection has been closed
+    return True
+
+
+class _CountingIter:
+    """Wraps a response body to count its size and to time the request until
+    the response has been sent."""
+
+    def __init__(self, app_iter, operation, start, status):
+        self.app_iter = app_iter
+        self.operation = operation
+        self.start = start
+        # set by start_response(), which may only be called by the app_iter
+        self.status = status
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+        finally:
+            response_bytes.inc(self.operation, self.size)
+            _record(self.operation, self.status[0] if self.status else "500", self.start)
+
+
+class MetricsMiddleware:
+    """Collects per-operation metrics of a SyncApp and serves them, along
+    with the state of its collections, at metrics_url."""
+
+    def __init__(self, app, metrics_url):
+        self.app = app
+        self.metrics_url = metrics_url
+        self.operations = set(app.valid_urls)
+
+        manager = app.collection_manager
+        registry.register(Gauge(
+            "ankisyncd_open_collections", "Collections currently open.",
+            lambda: sum(1 for col in list(manager.collections.values()) if _is_open(col))))
+        registry.register(Gauge(
+            "ankisyncd_collection_queue_depth", "Calls waiting for or running on collections.",
+            lambda: sum(col.queue_depth() for col in list(manager.collections.values())
+                        if hasattr(col, "queue_depth"))))
+
+    def operation(self, path):
+        for base_url in (self.app.base_url, self.app.base_media_url):
+            if path.startswith(base_url):
+                op = path[len(base_url):]
+                if op in self.operations:
+                    return op
+        return "other"
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == self.metrics_url:
+            body = registry.render().encode()
+            start_response("200 OK", [
+                ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+                ("Content-Length", str(len(body))),
+            ])
+            return [body]
+
+        operation = self.operation(path)
+        start = time.monotonic()
+        try:
+            request_bytes.inc(operation, int(environ.get('CONTENT_LENGTH') or 0))
+        except ValueError:
+            pass
+
+        status = []
+        def _start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line.split(" ", 1)[0]]
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            app_iter = self.app(environ, _start_response)
+        except Exception:
+            _record(operation, "500", start)
+            raise
+        return _CountingIter(app_iter, operation, start, status)
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+import bisect
+import contextvars
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from webob import Response
+
+import ankisyncd.log
+import ankisyncd.metrics
+from ankisyncd.collection import CollectionManager, WrapperCall, get_collection_wrapper
+from ankisyncd.full_sync import SnapshotFileIter, get_full_sync_manager
+from ankisyncd.sqlite_profile import get_sqlite_profile
+from ankisyncd.sync_app import SyncApp, SyncUserSession
+
+logger = logging.getLogger("ankisyncd.process")
+
+
+class HashRing:
+    """Maps keys to nodes by consistent hashing."""
+
+    def __init__(self, nodes, replicas=100):
+        self._ring = sorted((self._hash("%s-%d" % (node, i)), node)
+                            for node in nodes for i in range(replicas))
+        self._hashes = [h for h, node in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def get(self, key):
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+#
+# Sending calls to the worker processes
+#
+
+class _Pickler(pickle.Pickler):
+    """Replaces objects which only exist in the server process by their
+    counterparts in the worker process."""
+
+    def reducer_override(self, obj):
+        if isinstance(obj, SyncUserSession):
+            return _worker_session, (type(obj), obj.name, obj.path, obj.skey,
+                                     obj.created, obj.version, obj.client_version)
+        if isinstance(obj, SyncApp):
+            return _worker_app, (type(obj),)
+        return NotImplemented
+
+
+class _SpooledFile:
+    """A file object argument, written to a temporary file which the worker
+    process opens instead."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return open, (self.path, "rb")
+
+
+class _SnapshotResult:
+    def __init__(self, path, chunk_size, content_length):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.content_length = content_length
+
+    def response(self):
+        return Response(app_iter=SnapshotFileIter(self.path, self.chunk_size),
+                        content_length=self.content_length)
+
+
+class _BodyResult:
+    def __init__(self, body):
+        self.body = body
+
+    def response(self):
+        return Response(body=self.body)
+
+
+class ProcessCollectionProxy:
+    """Provides the same interface as ThreadingCollectionWrapper for a
+    collection which is opened in one of the worker processes.
+
+    Functions and their arguments have to be picklable. File objects among
+    the arguments are copied to a temporary file first, and responses are
+    read into memory, unless they stream a collection snapshot from disk."""
+
+    def __init__(self, worker, path, setup_new_collection=None):
+        self.worker = worker
+        self.path = path
+        self.setup_new_collection = setup_new_collection
+        # set by the ProcessCollectionManager which owns this proxy
+        self.manager = None
+
+    def __str__(self):
+        return "CollectionProxy[{}]".format(os.path.basename(os.path.dirname(self.path)))
+
+    def execute(self, func, args=[], kw={}, waitForReturn=True):
+        """Executes the given function in the worker process with the
+        collection as the first argument. Calls are always waited for, so
+        that they run in order."""
+
+        spooled = []
+        try:
+            args = [self._spool(arg, spooled) for arg in args]
+            buf = io.BytesIO()
+            _Pickler(buf).dump((ankisyncd.log.request_state(), self.path,
+                                self.setup_new_collection, func, args, kw))
+            name = getattr(func, '__name__', func.__class__.__name__)
+            ret, closed = pickle.loads(self.worker.call(buf.getvalue(), name))
+        finally:
+            for f in spooled:
+                os.unlink(f.path)
+
+        if closed and self.manager is not None:
+            self.manager.forget(closed)
+
+        if isinstance(ret, Exception):
+            raise ret
+        if isinstance(ret, (_SnapshotResult, _BodyResult)):
+            ret = ret.response()
+        if waitForReturn:
+            return ret
+
+    def _spool(self, arg, spooled):
+        if isinstance(arg, (bytes, str)) or not hasattr(arg, "read"):
+            return arg
+
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.path),
+                                         suffix=".spool", delete=False) as f:
+            spooled.append(_SpooledFile(f.name))
+            shutil.copyfileobj(arg, f, 64*1024)
+        return spooled[-1]
+
+    def open(self):
+        """Non-op. The collection will be opened on demand."""
+        pass
+
+    def replace(self, path):
+        """Replaces the collection file in the worker process."""
+        self.execute(WrapperCall("replace", path))
+
+
+class _WorkerProcess:
+    """The server side of a worker process. Calls are sent over a pipe one at
+    a time, the process is restarted if it dies.
+
+    The worker process runs one call at a time anyway, so the pipe is held
+    for the whole call. A slow call, like taking the snapshot of a big
+    collection for a full download, delays the calls of every other user
+    assigned to the process."""
+
+    def __init__(self, index, config):
+        self.index = index
+        self.config = dict(config)
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, name="ankisyncd-worker-%d" % self.index,
+            args=(self.config, child_conn, logging.getLogger().level),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def call(self, data, name):
+        queued_at = time.monotonic()
+        with self._lock:
+            ankisyncd.metrics.queue_seconds.observe(name, time.monotonic() - queued_at)
+            if not self.process.is_alive():
+                logger.error("Worker process %d died (exit code %s), restarting it",
+                             self.index, self.process.exitcode)
+                self._start()
+            try:
+                with ankisyncd.metrics.execute_seconds.time(name):
+                    self.conn.send_bytes(data)
+                    return self.conn.recv_bytes()
+            except (EOFError, OSError) as e:
+                raise RuntimeError("Worker process %d failed: %s" % (self.index, e))
+
+    def stop(self, timeout=30):
+        with self._lock:
+            try:
+                self.conn.send_bytes(b"")
+            except OSError:
+                pass
+            self.process.join(timeout)
+
+
+class ProcessCollectionManager(CollectionManager):
+    """Manages collections opened in a pool of worker processes, so that sync
+    operations of different users aren't limited to a single CPU core.
+
+    Collections are assigned to processes by consistent hashing of their
+    path. Each process runs one call at a time, in the order they were
+    sent, so a slow call delays the other users of its process.
+
+    The worker processes close idle collections on their own, and report
+    them with the result of their next call, to have their proxies
+    forgotten."""
+
+    def __init__(self, config):
+        super(ProcessCollectionManager, self).__init__(config)
+        workers = int(config['collection_processes'])
+        self.workers = [_WorkerProcess(i, config) for i in range(workers)]
+        self.ring = HashRing(range(workers))
+
+    def get_collection(self, path, setup_new_collection=None):
+        """Gets a ProcessCollectionProxy for the given path."""
+
+        path = os.path.realpath(path)
+
+        with self._lock:
+            try:
+                col = self.collections[path]
+            except KeyError:
+                worker = self.workers[self.ring.get(path)]
+                col = self.collections[path] = ProcessCollectionProxy(worker, path, setup_new_collection)
+                col.manager = self
+
+        return col
+
+    def forget(self, paths):
+        """Forgets the proxies of collections a worker process has closed."""
+        with self._lock:
+            for path in paths:
+                self.collections.pop(path, None)
+
+    def shutdown(self):
+        """Closes the collections and stops the worker processes."""
+        self.collections.clear()
+        for worker in self.workers:
+            worker.stop()
+
+
+#
+# Running in the worker processes
+#
+
+# the _Worker of this process, if it's a worker process
+_worker = None
+
+def _worker_session(cls, *state):
+    return _worker.session(cls, *state)
+
+def _worker_app(cls):
+    return _worker.app(cls)
+
+def _worker_main(config, conn, log_level):
+    global _worker
+
+    # Ctrl+C is handled by the server process, which stops us once it's done
+    # with the requests in progress
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ankisyncd.log.setup(log_level)
+    ankisyncd.log.configure(config)
+
+    _worker = _Worker(config, conn)
+    _worker.run()
+
+
+class _WorkerCollectionManager(CollectionManager):
+    # honors collection_wrapper, like ThreadingCollectionWrapper does
+    collection_wrapper = staticmethod(get_collection_wrapper)
+
+
+class _Worker:
+    """Runs the calls sent by the server process on the main thread of a
+    worker process, and closes collections which haven't been used for a
+    while."""
+
+    monitor_frequency = 15
+    # sessions which haven't been used for this long are forgotten
+    session_timeout = 3600
+
+    def __init__(self, config, conn):
+        self.config = config
+        self.conn = conn
+        self.collection_manager = _WorkerCollectionManager(config)
+        self.inactivity = int(config.get('collection_idle_timeout', 90))
+        sqlite_profile = get_sqlite_profile(config)
+        self.checkpoint_idle = sqlite_profile.checkpoint_idle if sqlite_profile.wal else 0
+        self.last_used = {}
+        self.checkpointed = {}
+        # collections closed for inactivity, which haven't been reported to
+        # the server process yet
+        self.closed = set()
+        self.sessions = {}
+        self.apps = {}
+
+    def session(self, cls, name, path, skey, created, version, client_version):
+        """Returns the counterpart of a session of the server process, which
+        keeps the state of its handlers between calls."""
+        key = (path, skey, created)
+        try:
+            session, last_used = self.sessions[key]
+        except KeyError:
+            session = cls(name, path, self.collection_manager)
+        session.skey = skey
+        session.version = version
+        session.client_version = client_version
+        self.sessions[key] = session, time.time()
+        return session
+
+    def app(self, cls):
+        """Returns a stand-in for the SyncApp of the server process, providing
+        what its operations on the collection need."""
+        try:
+            return self.apps[cls]
+        except KeyError:
+            app = self.apps[cls] = cls.__new__(cls)
+            app.full_sync_manager = get_full_sync_manager(self.config)
+            return app
+
+    def run(self):
+        logger.info("Worker process started")
+        last_sweep = time.monotonic()
+        try:
+            while True:
+                # busy workers have to close idle collections too
+                wait = self.monitor_frequency - (time.monotonic() - last_sweep)
+                if wait <= 0 or not self.conn.poll(wait):
+                    self._close_inactive()
+                    last_sweep = time.monotonic()
+                    continue
+                try:
+                    data = self.conn.recv_bytes()
+                except EOFError:
+                    break
+                if not data:
+                    break
+                # the request ID only applies to this call
+                self.conn.send_bytes(contextvars.copy_context().run(self._call, data))
+        finally:
+            self.collection_manager.shutdown()
+            logger.info("Worker process stopped")
+
+    def _call(self, data):
+        try:
+            request, path, setup_new_collection, func, args, kw = pickle.loads(data)
+            ankisyncd.log.restore_request(request)
+            self.last_used[path] = time.time()
+            self.closed.discard(path)
+            col = self.collection_manager.get_collection(path, setup_new_collection)
+            ret = self._result(col.execute(func, args, kw))
+        except Exception as e:
+            logger.error("Unable to run call: %s", e, exc_info=True)
+            ret = e
+
+        closed = list(self.closed)
+        self.closed.clear()
+        try:
+            return pickle.dumps((ret, closed))
+        except Exception:
+            return pickle.dumps((RuntimeError("Unable to send result: %r" % ret), closed))
+
+    @staticmethod
+    def _result(ret):
+        if not isinstance(ret, Response):
+            return ret
+        if isinstance(ret.app_iter, SnapshotFileIter):
+            # the server process streams the snapshot and removes it
+            ret.app_iter.file.close()
+            return _SnapshotResult(ret.app_iter.path, ret.app_iter.chunk_size,
+                                   ret.content_length)
+        try:
+            return _BodyResult(b"".join(ret.app_iter))
+        finally:
+            if hasattr(ret.app_iter, "close"):
+                ret.app_iter.close()
+
+    def _close_inactive(self):
+        cur = time.time()
+        for path, last_used in list(self.last_used.items()):
+            col = self.collection_manager.collections.get(path)
+            if col is not None and col.sync_in_progress():
+                # closing it would roll the sync back
+                continue
+            if cur - last_used >= self.inactivity:
+                logger.info("Closing collection on inactive %s", path)
+                self.collection_manager.collections.pop(path, None)
+                if col is not None:
+                    col.close()
+                del self.last_used[path]
+                self.closed.add(path)
+                self.checkpointed.pop(path, None)
+            elif self.checkpoint_idle and cur - last_used >= self.checkpoint_idle \
+                    and self.checkpointed.get(path, 0) < last_used:
+                if col is not None:
+                    try:
+                        col.checkpoint()
+                    except Exception as e:
+                        logger.error("Unable to checkpoint %s: %s", path, e, exc_info=True)
+                self.checkpointed[path] = cur
+
+        for key, (session, last_used) in list(self.sessions.items()):
+            if cur - last_used >= self.session_timeout:
+                del self.sessions[key]
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import logging
+import selectors
+import socket
+import threading
+import time
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+logger = logging.getLogger("ankisyncd.http")
+
+
+class RequestBody:
+    """A file-like wrapper around the connection which only allows reading the
+    body of the current request, so that the next request on a persistent
+    connection can be told apart from a body the application didn't read."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def _limit(self, size):
+        if size is None or size < 0 or size > self.remaining:
+            return self.remaining
+        return size
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        data = self.rfile.read(self._limit(size))
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        data = self.rfile.readline(self._limit(size))
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self, chunk_size=64*1024):
+        """Discards the unread part of the body. Returns False if the client
+        went away before sending all of it."""
+        try:
+            while self.remaining > 0:
+                if not self.read(chunk_size):
+                    return False
+        except OSError:
+            return False
+        return True
+
+
+class KeepAliveServerHandler(ServerHandler):
+    http_version = "1.1"
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers:
+            # The client can only tell where the response ends if we close
+            # the connection afterwards.
+            self.request_handler.close_connection = True
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+class RequestHandler(WSGIRequestHandler):
+    """Handles HTTP/1.1 persistent connections, unlike wsgiref's handler
+    which serves a single request per connection.
+
+    Unlike socketserver's handlers, creating one only sets the connection
+    up. The ThreadPoolWSGIServer calls handle() whenever a request can be
+    read from it, and finish() once it's closed."""
+
+    protocol_version = "HTTP/1.1"
+    logger = logger
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def setup(self):
+        # applies to every read from and write to the socket while a request
+        # is handled, handle_one_request() uses keepalive_timeout while
+        # waiting for the next one
+        self.timeout = self.server.request_timeout
+        WSGIRequestHandler.setup(self)
+
+    def log_error(self, format, *args):
+        self.logger.error("%s %s", self.address_string(), format%args)
+
+    def log_message(self, format, *args):
+        self.logger.info("%s %s", self.address_string(), format%args)
+
+    def handle(self):
+        """Handles the requests which can be read without waiting for the
+        client. Returns True if the connection should be kept open for the
+        next one."""
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and not self.server.draining:
+            if not self.request_buffered():
+                return True
+            self.handle_one_request()
+        return False
+
+    def request_buffered(self):
+        """Returns True if the start of the next request has been read into
+        rfile's buffer already, with the previous one. Waiting for the
+        connection to become readable would wait for more than that."""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            # left to the next read to report
+            return False
+        finally:
+            self.connection.settimeout(self.server.request_timeout)
+
+    def handle_one_request(self):
+        self.connection.settimeout(self.server.keepalive_timeout)
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+        finally:
+            self.connection.settimeout(self.server.request_timeout)
+
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request(): # An error code has been sent, just exit
+            return
+
+        if self.server.draining:
+            self.close_connection = True
+
+        environ = self.get_environ()
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self.send_error(400, "Bad Content-Length")
+            return
+        if 'HTTP_TRANSFER_ENCODING' in environ:
+            # chunked request bodies aren't supported by wsgiref
+            self.close_connection = True
+
+        body = RequestBody(self.rfile, length)
+        handler = KeepAliveServerHandler(
+            body, self.wfile, self.get_stderr(), environ,
+            multithread=True,
+        )
+        handler.request_handler = self      # backpointer for logging
+        handler.run(self.server.get_app())
+
+        if not body.drain():
+            self.close_connection = True
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """A WSGIServer which handles requests on a bounded pool of worker
+    threads, so that a slow request (e.g. a big media upload) doesn't block
+    other users.
+
+    Connections waiting for their next request don't hold a worker, a single
+    thread waits for them to become readable, and closes them after
+    keepalive_timeout seconds.
+
+    Requests for different collections run in parallel, requests for the same
+    collection are still serialized by the collection manager."""
+
+    def __init__(self, server_address, RequestHandlerClass, workers=16, keepalive_timeout=5,
+                 request_timeout=300):
+        WSGIServer.__init__(self, server_address, RequestHandlerClass)
+        self.keepalive_timeout = keepalive_timeout
+        # None lets slow clients take as long as they like
+        self.request_timeout = request_timeout or None
+        self.draining = False
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="ankisyncd-http")
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+
+        # handlers of the connections waiting for a request, passed on to
+        # the idle thread through _parked
+        self._parked = []
+        self._idle_lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._idle_thread = threading.Thread(target=self._serve_idle,
+                                             name="ankisyncd-http-idle")
+        self._idle_thread.daemon = True
+        self._idle_thread.start()
+
+    def process_request(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self._park(handler)
+
+    def _park(self, handler):
+        """Waits for the next request on the connection of handler, without
+        holding a worker."""
+        with self._idle_lock:
+            if not self.draining:
+                self._parked.append(handler)
+                handler = None
+        if handler is not None:
+            self._close(handler)
+            return
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            # the idle thread has been woken up already, or has stopped
+            pass
+
+    def _serve_idle(self):
+        # handler -> when it's closed, the keep-alive timeout is the same for
+        # all of them, so the first one expires first
+        deadlines = collections.OrderedDict()
+        while True:
+            timeout = None
+            if deadlines:
+                timeout = max(0, next(iter(deadlines.values())) - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                if key.fileobj is self._wakeup_recv:
+                    try:
+                        while self._wakeup_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                handler = key.data
+                self._selector.unregister(key.fileobj)
+                del deadlines[handler]
+                self._submit(handler)
+
+            with self._idle_lock:
+                parked, self._parked = self._parked, []
+                draining = self.draining
+            deadline = time.monotonic() + self.keepalive_timeout
+            for handler in parked:
+                self._selector.register(handler.connection, selectors.EVENT_READ, handler)
+                deadlines[handler] = deadline
+
+            now = time.monotonic()
+            while deadlines and (draining or next(iter(deadlines.values())) <= now):
+                handler, _ = deadlines.popitem(last=False)
+                self._selector.unregister(handler.connection)
+                self._close(handler)
+            if draining:
+                break
+
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+    def _submit(self, handler):
+        try:
+            future = self._executor.submit(self._handle, handler)
+        except RuntimeError:
+            # shut down while draining
+            self._close(handler)
+            return
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._forget_future)
+
+    def _forget_future(self, future):
+        with self._futures_lock:
+            self._futures.discard(future)
+
+    def _handle(self, handler):
+        try:
+            keep_open = handler.handle()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            keep_open = False
+        if keep_open:
+            self._park(handler)
+        else:
+            self._close(handler)
+
+    def _close(self, handler):
+        try:
+            handler.finish()
+        except OSError:
+            # the client went away before the response could be flushed
+            pass
+        finally:
+            self.shutdown_request(handler.request)
+
+    def drain(self, timeout=None):
+        """Stops accepting new connections and waits up to timeout seconds
+        for the requests in progress to finish. Persistent connections are
+        closed after their current request, idle ones right away."""
+        with self._idle_lock:
+            self.draining = True
+        self._wakeup()
+        self.server_close()
+
+        with self._futures_lock:
+            pending = list(self._futures)
+        if pending:
+            logger.info("Waiting for %d requests to finish...", len(pending))
+        done, not_done = concurrent.futures.wait(pending, timeout)
+        if not_done:
+            logger.warning("%d requests still running after %s seconds, "
+                           "exiting anyway", len(not_done), timeout)
+        self._executor.shutdown(wait=False)
+        self._idle_thread.join()
+
+
+def make_server(config, app):
+    httpd = ThreadPoolWSGIServer(
+        (config['host'], int(config['port'])), RequestHandler,
+        workers=int(config.get('server_workers', 16)),
+        keepalive_timeout=float(config.get('server_keepalive_timeout', 5)),
+        request_timeout=float(config.get('server_request_timeout', 300)),
+    )
+    httpd.set_app(app)
+    return httpd
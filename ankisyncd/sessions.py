@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
 import logging
+import threading
 from sqlite3 import dbapi2 as sqlite
 
 logger = logging.getLogger("ankisyncd.sessions")
@@ -11,30 +12,75 @@ class SimpleSessionManager:
 
     def __init__(self):
         self.sessions = {}
+        # Media sync requests only identify their session by the skey, so
+        # keep an index of skey -> hkey (and its reverse, to be able to drop
+        # outdated entries).
+        self.skeys = {}
+        self._hkey_skeys = {}
+
+    def _index_skey(self, hkey, skey):
+        old_skey = self._hkey_skeys.get(hkey)
+        if old_skey is not None and self.skeys.get(old_skey) == hkey:
+            del self.skeys[old_skey]
+        if skey is not None:
+            self.skeys[skey] = hkey
+        self._hkey_skeys[hkey] = skey
+
+    def _unindex_skey(self, hkey):
+        skey = self._hkey_skeys.pop(hkey, None)
+        if skey is not None and self.skeys.get(skey) == hkey:
+            del self.skeys[skey]
 
     def load(self, hkey, session_factory=None):
         return self.sessions.get(hkey)
 
     def load_from_skey(self, skey, session_factory=None):
-        for i in self.sessions:
-            if self.sessions[i].skey == skey:
-                return self.sessions[i]
+        hkey = self.skeys.get(skey)
+        if hkey is None:
+            return None
+
+        session = self.sessions.get(hkey)
+        # the skey of a session can be changed without saving it
+        if session is not None and session.skey == skey:
+            return session
 
     def save(self, hkey, session):
         self.sessions[hkey] = session
+        self._index_skey(hkey, session.skey)
 
     def delete(self, hkey):
         del self.sessions[hkey]
+        self._unindex_skey(hkey)
+
+    def flush(self):
+        """Writes out changes which haven't been persisted yet, if any."""
+        pass
 
 
 class SqliteSessionManager(SimpleSessionManager):
     """Stores sessions in a SQLite database to prevent the user from being logged out
-    everytime the SyncApp is restarted."""
+    everytime the SyncApp is restarted.
+
+    Every thread keeps its own connection to the database open. If
+    flush_interval is set, saved and deleted sessions are written to the
+    database in a single transaction at most flush_interval seconds later
+    instead of immediately, by a background thread."""
 
-    def __init__(self, session_db_path):
+    def __init__(self, session_db_path, flush_interval=0):
         SimpleSessionManager.__init__(self)
 
         self.session_db_path = os.path.realpath(session_db_path)
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        # hkey -> row to write, or None if the session has been deleted
+        self._pending = {}
+        # changes which are being written by flush()
+        self._flushing = {}
+        self._pending_lock = threading.Lock()
+        # serializes flushes, so that older changes can't overwrite newer ones
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
         self._ensure_schema_up_to_date()
 
     def _ensure_schema_up_to_date(self):
@@ -47,28 +93,58 @@ class SqliteSessionManager(SimpleSessionManager):
                        "WHERE sql LIKE '%user VARCHAR PRIMARY KEY%' "
                        "AND tbl_name = 'session'")
         res = cursor.fetchone()
-        conn.close()
         if res is not None:
             raise Exception("Outdated database schema, run utils/migrate_user_tables.py")
 
-    def _conn(self):
-        new = not os.path.exists(self.session_db_path)
+        # databases created by older versions don't have the skey index
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_session_skey ON session (skey)")
+        conn.commit()
+
+    def _connect(self):
         conn = sqlite.connect(self.session_db_path)
-        if new:
-            cursor = conn.cursor()
-            cursor.execute("CREATE TABLE session (hkey VARCHAR PRIMARY KEY, skey VARCHAR, username VARCHAR, path VARCHAR)")
+        cursor = conn.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS session (hkey VARCHAR PRIMARY KEY, skey VARCHAR, username VARCHAR, path VARCHAR)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_session_skey ON session (skey)")
+        return conn
+
+    def _conn(self):
+        # sqlite3 connections can't be shared between threads, so every
+        # thread gets its own one, which also caches its prepared statements
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
         return conn
 
+    def close(self):
+        """Stops the flusher thread, writes pending changes and closes the
+        calling thread's connection."""
+        self._stopped.set()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join()
+        self.flush()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
     # Default to using sqlite3 syntax but overridable for sub-classes using other
     # DB API 2 driver variants
     @staticmethod
     def fs(sql):
         return sql
 
+    def _deleted(self, hkey):
+        with self._pending_lock:
+            if hkey in self._pending:
+                return self._pending[hkey] is None
+            return hkey in self._flushing and self._flushing[hkey] is None
+
     def load(self, hkey, session_factory=None):
         session = SimpleSessionManager.load(self, hkey)
         if session is not None:
             return session
+        if self._deleted(hkey):
+            return None
 
         conn = self._conn()
         cursor = conn.cursor()
@@ -79,6 +155,7 @@ class SqliteSessionManager(SimpleSessionManager):
         if res is not None:
             session = self.sessions[hkey] = session_factory(res[1], res[2])
             session.skey = res[0]
+            self._index_skey(hkey, session.skey)
             return session
 
     def load_from_skey(self, skey, session_factory=None):
@@ -92,35 +169,91 @@ class SqliteSessionManager(SimpleSessionManager):
         cursor.execute(self.fs("SELECT hkey, username, path FROM session WHERE skey=?"), (skey,))
         res = cursor.fetchone()
 
-        if res is not None:
+        # the row may be outdated, if the session is loaded already, its skey
+        # has been changed since, and the change may not be written yet
+        if res is not None and res[0] not in self.sessions and not self._deleted(res[0]):
             session = self.sessions[res[0]] = session_factory(res[1], res[2])
             session.skey = skey
+            self._index_skey(res[0], skey)
             return session
 
     def save(self, hkey, session):
         SimpleSessionManager.save(self, hkey, session)
-
-        conn = self._conn()
-        cursor = conn.cursor()
-
-        cursor.execute("INSERT OR REPLACE INTO session (hkey, skey, username, path) VALUES (?, ?, ?, ?)",
-            (hkey, session.skey, session.name, session.path))
-
-        conn.commit()
+        self._write(hkey, (hkey, session.skey, session.name, session.path))
 
     def delete(self, hkey):
         SimpleSessionManager.delete(self, hkey)
-
-        conn = self._conn()
-        cursor = conn.cursor()
-
-        cursor.execute(self.fs("DELETE FROM session WHERE hkey=?"), (hkey,))
-        conn.commit()
+        self._write(hkey, None)
+
+    def _write(self, hkey, row):
+        with self._pending_lock:
+            self._pending[hkey] = row
+            if self.flush_interval and self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher,
+                                                 name="ankisyncd-session-flusher")
+                self._flusher.daemon = True
+                self._flusher.start()
+
+        if not self.flush_interval:
+            self.flush()
+
+    def _run_flusher(self):
+        # a single thread, which keeps one connection open for all the
+        # delayed flushes
+        try:
+            while not self._stopped.wait(self.flush_interval):
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Unable to write sessions to %s", self.session_db_path)
+        finally:
+            conn = getattr(self._local, 'conn', None)
+            if conn is not None:
+                conn.close()
+
+    def flush(self):
+        """Writes all pending session changes to the database."""
+        with self._flush_lock:
+            # the changes are taken out of _pending, so that load() isn't
+            # blocked while they are committed. Until then, _flushing keeps
+            # load() from finding a session which has just been deleted.
+            with self._pending_lock:
+                if not self._pending:
+                    return
+                pending = self._flushing = self._pending
+                self._pending = {}
+
+            try:
+                saved = [row for row in pending.values() if row is not None]
+                deleted = [(hkey,) for hkey, row in pending.items() if row is None]
+
+                conn = self._conn()
+                cursor = conn.cursor()
+
+                if saved:
+                    cursor.executemany("INSERT OR REPLACE INTO session (hkey, skey, username, path) VALUES (?, ?, ?, ?)",
+                        saved)
+                if deleted:
+                    cursor.executemany(self.fs("DELETE FROM session WHERE hkey=?"), deleted)
+
+                conn.commit()
+            except:
+                # put the changes back for the next flush, unless they have
+                # been superseded in the meantime
+                with self._pending_lock:
+                    pending.update(self._pending)
+                    self._pending = pending
+                    self._flushing = {}
+                raise
+
+            with self._pending_lock:
+                self._flushing = {}
 
 def get_session_manager(config):
     if "session_db_path" in config and config["session_db_path"]:
         logger.info("Found session_db_path in config, using SqliteSessionManager for auth")
-        return SqliteSessionManager(config['session_db_path'])
+        return SqliteSessionManager(config['session_db_path'],
+                                    float(config.get('session_db_flush_interval') or 0))
     elif "session_manager" in config and config["session_manager"]:  # load from config
         logger.info("Found session_manager in config, using {} for persisting sessions".format(
             config['session_manager'])
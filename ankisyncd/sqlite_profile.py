@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import logging
+import re
+
+logger = logging.getLogger("ankisyncd.sqlite_profile")
+
+# pragmas which can be set with sqlite_<pragma> in the config
+PRAGMAS = ("journal_mode", "synchronous", "mmap_size", "cache_size", "temp_store")
+
+PROFILES = {
+    # keeps the settings Anki and SQLite use
+    "default": {},
+    # collection and media databases are only ever used by the server, so
+    # WAL's readers not blocking the writer is less important than commits
+    # not having to fsync the journal. With synchronous = normal, a power
+    # loss can lose the last commits, but not corrupt the database.
+    "wal": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 64 * 1024 * 1024,
+        "cache_size": -16 * 1024,  # KiB
+        "temp_store": "memory",
+    },
+}
+
+_valid_value = re.compile(r"-?[A-Za-z0-9]+\Z")
+
+
+class SqliteProfile:
+    """Settings the server applies to the collection and media databases it
+    opens."""
+
+    def __init__(self, config=None):
+        config = config or {}
+        name = config.get('sqlite_profile') or "default"
+        if name not in PROFILES:
+            raise ValueError("Unsupported sqlite_profile: {}".format(name))
+
+        self.pragmas = dict(PROFILES[name])
+        for pragma in PRAGMAS:
+            value = config.get('sqlite_' + pragma)
+            if value:
+                self.pragmas[pragma] = value
+        for pragma, value in self.pragmas.items():
+            if not _valid_value.match(str(value)):
+                raise ValueError("Unsupported sqlite_{}: {}".format(pragma, value))
+
+        # seconds a collection has to be idle for before the WAL is
+        # checkpointed, 0 leaves it to SQLite
+        self.checkpoint_idle = int(config.get('sqlite_checkpoint_idle', 30))
+
+    @property
+    def wal(self):
+        return str(self.pragmas.get("journal_mode", "")).lower() == "wal"
+
+    def apply(self, db):
+        """Applies the pragmas to an anki.db.DB. Commits first, as the journal
+        mode and synchronous flag can't be changed inside a transaction."""
+        if not self.pragmas:
+            return
+        db.commit()
+        for pragma, value in self.pragmas.items():
+            db.execute("pragma %s = %s" % (pragma, value))
+
+    def checkpoint(self, db):
+        """Copies the WAL of an anki.db.DB back into the database and truncates
+        it. The server is the only user of the database, so this doesn't have
+        to wait for other readers. Databases with uncommitted changes are
+        skipped, Anki's empty lock transaction is committed."""
+        if not self.wal:
+            return
+        if db._db.in_transaction:
+            if db.mod:
+                return
+            db.commit()
+        busy, log, checkpointed = db.first("pragma wal_checkpoint(truncate)")
+        if busy:
+            logger.warning("Unable to checkpoint %s, the database is busy", db._path)
+
+
+def get_sqlite_profile(config):
+    return SqliteProfile(config)
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import gzip
 import hashlib
 import io
@@ -26,6 +27,7 @@ import string
 import sys
 import time
 import unicodedata
+import uuid
 import zipfile
 from configparser import ConfigParser
 from sqlite3 import dbapi2 as sqlite
@@ -40,6 +42,10 @@ import anki.utils
 from anki.consts import SYNC_VER, SYNC_ZIP_SIZE, SYNC_ZIP_COUNT
 from anki.consts import REM_CARD, REM_NOTE
 
+import ankisyncd.log
+import ankisyncd.media_cache
+import ankisyncd.media_store
+import ankisyncd.media_zip
 from ankisyncd.users import get_user_manager
 from ankisyncd.sessions import get_session_manager
 from ankisyncd.full_sync import get_full_sync_manager
@@ -48,12 +54,80 @@ logger = logging.getLogger("ankisyncd")
 
 
 class SyncCollectionHandler(anki.sync.Syncer):
-    operations = ['meta', 'applyChanges', 'start', 'applyGraves', 'chunk', 'applyChunk', 'sanityCheck2', 'finish']
+    operations = ['meta', 'applyChanges', 'start', 'applyGraves', 'chunk', 'applyChunk', 'sanityCheck2', 'finish', 'abort']
+    # operations which don't have to be saved, what little they change (like
+    # the usn of objects sent by chunk) is committed by the next save
+    read_only_operations = ['meta', 'chunk', 'sanityCheck2']
 
-    def __init__(self, col):
+    def __init__(self, col, config=None):
         # So that 'server' (the 3rd argument) can't get set
         anki.sync.Syncer.__init__(self, col)
 
+        if config is None:
+            config = {}
+        # seconds an incremental sync may take if its changes are kept in a
+        # single transaction, from start until finish commits it, 0 commits
+        # every operation on its own
+        self.transaction_timeout = int(config.get('sync_transaction_timeout', 0))
+        self.transaction_started = None
+
+    def needs_save(self, operation):
+        """Returns True if the collection has to be saved after operation."""
+        return operation not in self.read_only_operations and not self.in_transaction()
+
+    #
+    # Sync transactions. The collection is marked with the handler whose sync
+    # is in progress, so that other sessions syncing the same collection, and
+    # CollectionWrapper.close(), don't commit it.
+    #
+
+    def in_transaction(self):
+        return getattr(self.col, 'sync_transaction', None) is self
+
+    def expired(self):
+        """Returns True if the sync has taken longer than the timeout."""
+        return self.transaction_started is not None and \
+            time.monotonic() - self.transaction_started > self.transaction_timeout
+
+    def _begin_transaction(self):
+        if getattr(self.col, 'sync_transaction', None) is not None:
+            logger.warning("Rolling back unfinished sync of %s", self.col.path)
+            self._rollback()
+        self.col.sync_transaction = self
+        self.transaction_started = time.monotonic()
+
+    def _check_transaction(self):
+        """Raises an HTTP error if the transaction of the sync in progress was
+        rolled back, or has taken too long, in which case it's rolled back."""
+        if not self.transaction_timeout:
+            return
+        if not self.in_transaction():
+            raise HTTPConflict("The sync was aborted, please sync again.")
+        if self.expired():
+            logger.warning("Sync of %s took over %d seconds, rolling it back",
+                           self.col.path, self.transaction_timeout)
+            self._rollback()
+            raise HTTPConflict("The sync took too long, please sync again.")
+
+    def _rollback(self):
+        self.col.rollback()
+        self.col.sync_transaction = None
+
+    def _end_transaction(self):
+        if self.in_transaction():
+            self.col.sync_transaction = None
+
+    #
+    # The collection is also marked with the handler of an incremental sync
+    # from start until finish, whether it's kept in a transaction or not, so
+    # that it isn't closed to make room for others in the meantime, which
+    # would lose the state of chunk().
+    #
+
+    def _end_sync(self):
+        if getattr(self.col, 'sync_handler', None) is self:
+            self.col.sync_handler = None
+
     @staticmethod
     def _old_client(cv):
         if not cv:
@@ -118,8 +192,12 @@ class SyncCollectionHandler(anki.sync.Syncer):
         # minUsn - 客户端usn
         # maxUsn - 服务端us
         # minUsn <= maxUsn
+        if self.transaction_timeout:
+            self._begin_transaction()
+        self.col.sync_handler = self
         self.maxUsn = self.col._usn
-        print("▶ 开始执行start方法，maxUsn: {}, minUsn: {}, lnewer: {}, graves: {}".format(self.maxUsn, minUsn, lnewer, graves))
+        logger.debug("start: maxUsn %d, minUsn %d, lnewer %s", self.maxUsn, minUsn, lnewer)
+        ankisyncd.log.debug_payload(logger, "start: graves %s", graves)
         # 客户端入参minUsn，来自最近一次调用服务端/sync/meta接口返回的meta[usn]
         # 这个值不可能大于服务端usn，因为有可能其他客户端已经同步过数据，即增加过maxUsn
         self.minUsn = minUsn
@@ -129,24 +207,51 @@ class SyncCollectionHandler(anki.sync.Syncer):
         return lgraves
 
     def applyGraves(self, chunk):
+        self._check_transaction()
         self.remove(chunk)
 
     def applyChanges(self, changes):
+        self._check_transaction()
         self.rchg = changes
         lchg = self.changes()
         # merge our side before returning
         self.mergeChanges(lchg, self.rchg)
         return lchg
 
+    def chunk(self):
+        self._check_transaction()
+        return anki.sync.Syncer.chunk(self)
+
+    def applyChunk(self, chunk):
+        self._check_transaction()
+        anki.sync.Syncer.applyChunk(self, chunk)
+
     def sanityCheck2(self, client):
+        self._check_transaction()
         server = self.sanityCheck()
-        print("client: {}, server: {}".format(client, server))
+        ankisyncd.log.debug_payload(logger, "sanityCheck2: client %s, server %s", client, server)
         if client != server:
+            # the client will force a full sync, don't keep what it sent
+            if self.in_transaction():
+                self._rollback()
+            self._end_sync()
             return dict(status="bad", c=client, s=server)
         return dict(status="ok")
 
     def finish(self, mod=None):
-        return anki.sync.Syncer.finish(self, anki.utils.intTime(1000))
+        self._check_transaction()
+        # saves the collection, which commits the sync's transaction
+        mod = anki.sync.Syncer.finish(self, anki.utils.intTime(1000))
+        self._end_transaction()
+        self._end_sync()
+        return mod
+
+    def abort(self):
+        """Called by the client when it gives up on a sync."""
+        if self.in_transaction():
+            logger.info("Sync of %s aborted by the client, rolling it back", self.col.path)
+            self._rollback()
+        self._end_sync()
 
     # This function had to be put here in its entirety because Syncer.removed()
     # doesn't use self.usnLim() (which we override in this class) in queries.
@@ -184,10 +289,28 @@ class SyncCollectionHandler(anki.sync.Syncer):
 
 class SyncMediaHandler:
     operations = ['begin', 'mediaChanges', 'mediaSanity', 'uploadChanges', 'downloadFiles']
+    read_only_operations = ['begin', 'mediaChanges', 'mediaSanity', 'downloadFiles']
 
-    def __init__(self, col):
+    def __init__(self, col, config=None):
         self.col = col
 
+        if config is None:
+            config = {}
+        # number of threads saving the files of an upload, 1 saves them on
+        # the collection thread
+        self.upload_workers = int(config.get('media_upload_workers', 1))
+        # zlib compression level for files sent by downloadFiles, 0 sends
+        # all files uncompressed
+        self.compression_level = int(config.get('media_compression_level', 6))
+        self.cache = ankisyncd.media_cache.get_media_cache(config)
+        self.store = ankisyncd.media_store.get_media_store(config)
+        # most changes returned by a single mediaChanges call, the client
+        # keeps asking for more until it gets an empty list
+        self.changes_page_size = int(config.get('media_changes_page_size', 5000))
+
+    def needs_save(self, operation):
+        return operation not in self.read_only_operations
+
     def begin(self, skey):
         return {
             'data': {
@@ -237,50 +360,80 @@ class SyncMediaHandler:
         meta = json.loads(zip_file.read("_meta").decode())
         # Remove media files that were removed on the client.
         media_to_remove = []
-        print("被删除的文件保存在meta中，meta:{}".format(meta))
+        ankisyncd.log.debug_payload(logger, "uploadChanges: meta %s", meta)
         for normname, ordinal in meta:
-            print("meta数据，normname: {}, ordinal: {}".format(normname, ordinal))
             if ordinal == None or ordinal == "":
                 media_to_remove.append(self._normalize_filename(normname))
 
         # Add media files that were added on the client.
         media_to_add = []
-        usn = self.col.media.lastUsn()
-        oldUsn = usn
-        print("zip_file.infolist() ----> {}".format(zip_file.infolist()))
+        oldUsn = self.col.media.lastUsn()
+        members = []
         for i in zip_file.infolist():
             if i.filename == "_meta":  # Ignore previously retrieved metadata.
                 continue
 
-            file_data = zip_file.read(i)
-            csum = anki.utils.checksum(file_data)
             filename = self._normalize_filename(meta[int(i.filename)][0])
-            file_path = os.path.join(self.col.media.dir(), filename)
+            members.append((i, filename))
 
-            # Save file to media directory.
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
+        # Save files to media directory.
+        save = lambda member: self._save_zip_member(zip_file, *member)
+        if self.upload_workers > 1 and len(members) > 1:
+            with concurrent.futures.ThreadPoolExecutor(self.upload_workers) as executor:
+                csums = list(executor.map(save, members))
+        else:
+            csums = [save(member) for member in members]
 
-            usn += 1
-            media_to_add.append((filename, usn, csum))
+        for (i, filename), csum in zip(members, csums):
+            media_to_add.append((filename, csum))
 
         # We count all files we are to remove, even if we don't have them in
         # our media directory and our db doesn't know about them.
         processed_count = len(media_to_remove) + len(media_to_add)
-        print("len(meta): {}, processed_count: {}".format(len(meta), processed_count))
+        logger.debug("uploadChanges: %d added, %d removed", len(media_to_add), len(media_to_remove))
         assert len(meta) == processed_count  # sanity check
 
         if media_to_remove:
             self._remove_media_files(media_to_remove)
 
         if media_to_add:
-            self.col.media.db.executemany(
-                "INSERT OR REPLACE INTO media VALUES (?,?,?)", media_to_add)
-            self.col.media.db.commit()
+            try:
+                self.col.media.syncAdd(media_to_add)
+                self.col.media.db.commit()
+            except Exception:
+                self.col.media.rollback()
+                raise
 
         assert self.col.media.lastUsn() == oldUsn + processed_count  # TODO: move to some unit test
         return processed_count
 
+    def _save_zip_member(self, zip_file, zip_info, filename):
+        """
+        Streams a file from the zip to a temporary file in the media
+        directory, which is then moved into place. Returns the checksum of
+        the file, computed while copying it.
+        """
+
+        media_dir = self.col.media.dir()
+        temp_path = os.path.join(media_dir, ".upload-" + uuid.uuid4().hex)
+        sha1 = hashlib.sha1()
+
+        try:
+            with zip_file.open(zip_info) as src, open(temp_path, 'xb') as dst:
+                for chunk in iter(lambda: src.read(64*1024), b''):
+                    sha1.update(chunk)
+                    dst.write(chunk)
+            os.replace(temp_path, os.path.join(media_dir, filename))
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+        csum = sha1.hexdigest()
+        if self.store is not None:
+            self.store.add(os.path.join(media_dir, filename), csum)
+        return csum
+
     @staticmethod
     def _normalize_filename(filename):
         """
@@ -302,46 +455,68 @@ class SyncMediaHandler:
         media directory.
         """
         logger.debug('Removing %d files from media dir.' % len(filenames))
-        for filename in filenames:
-            try:
-                self.col.media.syncDelete(filename)
-                self.col.media.db.commit()
-            except OSError as err:
-                logger.error("Error when removing file '%s' from media dir: "
-                              "%s" % (filename, str(err)))
+        self.col.media.syncDeleteMany(filenames)
 
     def downloadFiles(self, files):
         flist = {}
         cnt = 0
         sz = 0
-        f = io.BytesIO()
+        members = []
 
-        with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        # The files are opened right away, so that the response can be
+        # streamed outside of the collection thread even if some of them get
+        # removed in the meantime.
+        try:
             for fname in files:
-                z.write(os.path.join(self.col.media.dir(), fname), str(cnt))
+                f = open(os.path.join(self.col.media.dir(), fname), 'rb')
+                size = os.fstat(f.fileno()).st_size
+                if self.compression_level:
+                    # already compressed formats are stored as they are
+                    compress_type = ankisyncd.media_zip.compress_type(
+                        fname, f.read(ankisyncd.media_zip.SNIFF_SIZE))
+                    f.seek(0)
+                else:
+                    compress_type = zipfile.ZIP_STORED
+                if self.cache is not None and compress_type == zipfile.ZIP_DEFLATED:
+                    csum = self.col.media.db.scalar(
+                        "SELECT csum FROM media WHERE fname=?", fname)
+                else:
+                    csum = None
+                members.append((str(cnt), f, size, compress_type, csum))
                 flist[str(cnt)] = fname
-                sz += os.path.getsize(os.path.join(self.col.media.dir(), fname))
+                sz += size
                 if sz > SYNC_ZIP_SIZE or cnt > SYNC_ZIP_COUNT:
                     break
                 cnt += 1
+        except Exception:
+            for name, f, size, compress_type, csum in members:
+                f.close()
+            raise
 
-            z.writestr("_meta", json.dumps(flist))
+        meta = json.dumps(flist).encode()
+        members.append(("_meta", meta, len(meta), zipfile.ZIP_DEFLATED, None))
 
-        return f.getvalue()
+        return Response(app_iter=ankisyncd.media_zip.stream_zip(
+            members, compresslevel=self.compression_level or None,
+            cache=self.cache))
 
     def mediaChanges(self, lastUsn):
-        result = []
-        server_lastUsn = self.col.media.lastUsn()
-        fname = csum = None
-
-        if lastUsn < server_lastUsn or lastUsn == 0:
-            for fname,usn,csum, in self.col.media.db.execute("select fname,usn,csum from media order by usn desc limit ?", server_lastUsn - lastUsn):
-                result.append([fname, usn, csum])
-
-        # anki assumes server_lastUsn == result[-1][1]
+        result = [list(row) for row in self.col.media.db.execute(
+            "select fname,usn,csum from media where usn > ? order by usn limit ?",
+            lastUsn, self.changes_page_size)]
+
+        if len(result) == self.changes_page_size:
+            # The client continues from the USN of the last file, so files
+            # sharing it (e.g. migrated from a client database) can't be
+            # split between pages.
+            last_usn = result[-1][1]
+            result = [row for row in result if row[1] != last_usn]
+            result.extend(list(row) for row in self.col.media.db.execute(
+                "select fname,usn,csum from media where usn = ?", last_usn))
+
+        # anki assumes server_lastUsn == result[-1][1] once it's seen all
+        # pages, so they have to be in ascending order
         # ref: anki/sync.py:720 (commit cca3fcb2418880d0430a5c5c2e6b81ba260065b7)
-        result.reverse()
-
         return {'data': result, 'err': ''}
 
     def mediaSanity(self, local=None):
@@ -387,13 +562,41 @@ class SyncUserSession:
             raise Exception("no handler for {}".format(operation))
 
         if getattr(self, attr) is None:
-            setattr(self, attr, handler_class(col))
+            setattr(self, attr, handler_class(col, self.collection_manager.config))
         handler = getattr(self, attr)
         # The col object may actually be new now! This happens when we close a collection
         # for inactivity and then later re-open it (creating a new Collection object).
         handler.col = col
         return handler
 
+def sync_in_progress(col):
+    """Returns True if the changes of an incremental sync of the collection
+    are kept in a transaction which its finish hasn't committed yet."""
+    return getattr(col, 'sync_transaction', None) is not None
+
+class HandlerMethodCall:
+    """Calls a handler method of a session with the collection as self.col.
+    It's a class rather than a closure so that it can be pickled and sent to
+    another process."""
+
+    def __init__(self, method_name, session):
+        self.method_name = method_name
+        self.session = session
+        self.__name__ = method_name  # More useful debugging messages.
+
+    def __call__(self, col, **keyword_args):
+        # Retrieve the correct handler method.
+        handler = self.session.get_handler_for_operation(self.method_name, col)
+        handler_method = getattr(handler, self.method_name)
+
+        res = handler_method(**keyword_args)
+
+        # a sync in progress is only committed by its finish, not by the
+        # calls of other sessions which run in between
+        if handler.needs_save(self.method_name) and not sync_in_progress(col):
+            col.save()
+        return res
+
 class SyncApp:
     valid_urls = SyncCollectionHandler.operations + SyncMediaHandler.operations + ['hostKey', 'upload', 'download']
 
@@ -411,6 +614,7 @@ class SyncApp:
         self.user_manager = get_user_manager(config)
         self.session_manager = get_session_manager(config)
         self.full_sync_manager = get_full_sync_manager(config)
+        self.full_sync_manager.remove_stale_snapshots(self.data_root)
         self.collection_manager = get_collection_manager(config)
 
         # make sure the base_url has a trailing slash
@@ -476,6 +680,12 @@ class SyncApp:
 
         return data
 
+    @staticmethod
+    def _decode_stream(fileobj, compression=0):
+        if compression:
+            return gzip.GzipFile(mode="rb", fileobj=fileobj)
+        return fileobj
+
     def operation_hostKey(self, username, password):
         if not self.user_manager.authenticate(username, password):
             return
@@ -491,20 +701,25 @@ class SyncApp:
 
         return {'key': hkey}
 
-    def operation_upload(self, col, data, session):
-        # Verify integrity of the received database file before replacing our
-        # existing db.
-
-        return self.full_sync_manager.upload(col, data, session)
+    def operation_upload(self, wrapper, data, session):
+        # Verifies the received database file, then has the wrapper replace
+        # our existing db with it.
+        return self.full_sync_manager.upload(wrapper, data, session)
 
     def operation_download(self, col, session):
         # returns user data (not media) as a sqlite3 database for replacing their
         # local copy in Anki
+        # the snapshot is of the committed state, which read-only operations
+        # may have left behind, unless another device's sync is in progress
+        if not sync_in_progress(col):
+            col.save()
         return self.full_sync_manager.download(col, session)
 
     @wsgify
     def __call__(self, req):
-        print("🌟 Request path: {}".format(req.path))
+        ankisyncd.log.start_request(req.headers.get('X-Request-Id'))
+        logger.debug("%s %s", req.method, req.path)
+
         # Get and verify the session
         try:
             hkey = req.POST['k']
@@ -514,7 +729,6 @@ class SyncApp:
         if hkey is None:
             try:
                 hkey = req.GET['k']
-                print(req.GET)
             except KeyError:
                 hkey = None
 
@@ -534,12 +748,19 @@ class SyncApp:
             compression = 0
 
         try:
-            data = req.POST['data'].file.read()
-            data = self._decode_data(data, compression)
+            data_file = req.POST['data'].file
         except KeyError:
             data = {}
+        else:
+            if req.path == self.base_url + 'upload':
+                # Full uploads can be hundreds of megabytes big, so they're
+                # streamed to disk by the full sync manager instead of being
+                # decoded in memory.
+                data = {'data': self._decode_stream(data_file, compression)}
+            else:
+                data = self._decode_data(data_file.read(), compression)
 
-        print("POST file data: {}".format(data))
+        ankisyncd.log.debug_payload(logger, "%s data: %s", req.path, data)
 
         if req.path.startswith(self.base_url):
             url = req.path[len(self.base_url):]
@@ -590,7 +811,7 @@ class SyncApp:
                 thread = session.get_thread()
                 if url in self.prehooks:
                     thread.execute(self.prehooks[url], [session])
-                result = thread.execute(self.operation_upload, [data['data'], session])
+                result = self.operation_upload(thread, data['data'], session)
                 if url in self.posthooks:
                     thread.execute(self.posthooks[url], [session])
                 return result
@@ -624,7 +845,7 @@ class SyncApp:
             result = self._execute_handler_method_in_thread(url, data, session)
 
             # If it's a complex data type, we convert it to JSON
-            if type(result) not in (str, bytes):
+            if type(result) not in (str, bytes, Response):
                 result = json.dumps(result)
 
             return result
@@ -639,19 +860,9 @@ class SyncApp:
         self.col.
         """
 
-        def run_func(col, **keyword_args):
-            # Retrieve the correct handler method.
-            handler = session.get_handler_for_operation(method_name, col)
-            handler_method = getattr(handler, method_name)
-
-            res = handler_method(**keyword_args)
-
-            col.save()
-            return res
+        run_func = HandlerMethodCall(method_name, session)
 
-        run_func.__name__ = method_name  # More useful debugging messages.
-
-        # Send the closure to the thread for execution.
+        # Send the call to the thread for execution.
         thread = session.get_thread()
         result = thread.execute(run_func, kw=keyword_args)
 
@@ -662,30 +873,30 @@ def make_app(global_conf, **local_conf):
     return SyncApp(**local_conf)
 
 def main():
-    logging.basicConfig(level=logging.INFO, format="[%(asctime)s]:%(levelname)s:%(name)s:%(message)s")
     import ankisyncd
+    ankisyncd.log.setup()
     logger.info("ankisyncd {} ({})".format(ankisyncd._get_version(), ankisyncd._homepage))
-    from wsgiref.simple_server import make_server, WSGIRequestHandler
+    import signal
+    from ankisyncd.server import make_server
     from ankisyncd.thread import shutdown
     import ankisyncd.config
 
-    class RequestHandler(WSGIRequestHandler):
-        logger = logging.getLogger("ankisyncd.http")
-
-        def log_error(self, format, *args):
-            self.logger.error("%s %s", self.address_string(), format%args)
-
-        def log_message(self, format, *args):
-            self.logger.info("%s %s", self.address_string(), format%args)
-
     if len(sys.argv) > 1:
         # backwards compat
         config = ankisyncd.config.load(sys.argv[1])
     else:
         config = ankisyncd.config.load()
+    ankisyncd.log.configure(config)
 
     ankiserver = SyncApp(config)
-    httpd = make_server(config['host'], int(config['port']), ankiserver, handler_class=RequestHandler)
+    app = ankiserver
+    if config.get('metrics_url'):
+        from ankisyncd.metrics import MetricsMiddleware
+        app = MetricsMiddleware(ankiserver, config['metrics_url'])
+    httpd = make_server(config, app)
+
+    # drain the server on SIGTERM as well
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     try:
         logger.info("Serving HTTP on {} port {}...".format(*httpd.server_address))
@@ -693,6 +904,8 @@ def main():
     except KeyboardInterrupt:
         logger.info("Exiting...")
     finally:
+        httpd.drain(float(config.get('server_drain_timeout', 30)))
+        ankiserver.session_manager.flush()
         shutdown()
 
 if __name__ == '__main__': main()
@@ -1,65 +1,111 @@
-from ankisyncd.collection import CollectionManager, get_collection_wrapper
+from ankisyncd.collection import CollectionManager, WrapperCall, get_collection_wrapper
+import ankisyncd.log
+import ankisyncd.metrics
+from ankisyncd.log import LazyRepr
+from ankisyncd.sqlite_profile import get_sqlite_profile
 
-from threading import Thread
+from threading import Thread, Lock, Event, current_thread
 from queue import Queue
 
-import time, logging
+import contextvars, os, time, logging, zlib
 
-def short_repr(obj, logger=logging.getLogger(), maxlen=80):
-    """Like repr, but shortens strings and bytestrings if logger's logging level
-    is above DEBUG. Currently shallow and very limited, only implemented for
-    dicts and lists."""
-    if logger.isEnabledFor(logging.DEBUG):
-        return repr(obj)
+class CollectionWorker:
+    """A thread which runs the functions queued for the collections assigned
+    to it, in the order they were queued.
 
-    def shorten(s):
-        if isinstance(s, (bytes, str)) and len(s) > maxlen:
-            return s[:maxlen] + ("..." if isinstance(s, str) else b"...")
-        else:
-            return s
+    Anki's database connections can only be used by the thread which opened
+    them, so a collection has to stay on the same worker for as long as it's
+    open."""
+
+    def __init__(self, name):
+        self.name = name
+        self.logger = logging.getLogger("ankisyncd." + name)
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, name=name)
+        self._thread.start()
+
+    def put(self, wrapper, func, args, kw, return_queue):
+        # the function runs in the context of the caller, to keep the request
+        # ID in log messages
+        context = contextvars.copy_context()
+        self._queue.put((wrapper, func, args, kw, return_queue, time.monotonic(), context))
+
+    def qempty(self):
+        return self._queue.empty()
+
+    def current(self):
+        return current_thread() == self._thread
+
+    def _run(self):
+        self.logger.info("Starting...")
+        while True:
+            item = self._queue.get(True)
+            if item is None:
+                break
+            wrapper, func, args, kw, return_queue, queued_at, context = item
+            try:
+                context.run(wrapper._process, func, args, kw, return_queue, queued_at)
+            except Exception as e:
+                self.logger.error("Unexpected error in %s: %s", wrapper, e, exc_info=True)
+        self.logger.info("Stopped!")
+
+    def stop(self):
+        """Stops the thread after everything queued so far has run."""
+        self._queue.put(None)
 
-    o = obj.copy()
-    if isinstance(o, dict):
-        for k in o:
-            o[k] = shorten(o[k])
-    elif isinstance(o, list):
-        for k in range(len(o)):
-            o[k] = shorten(o[k])
+    def join(self):
+        self._thread.join()
 
-    return repr(o)
+# queued instead of a function to checkpoint the collection's databases
+_CHECKPOINT = object()
 
 class ThreadingCollectionWrapper:
-    """Provides the same interface as CollectionWrapper, but it creates a new Thread to
-    interact with the collection."""
+    """Provides the same interface as CollectionWrapper, but interacts with the
+    collection on a CollectionWorker thread. Unless a worker shared with other
+    collections is given, it starts one of its own."""
 
-    def __init__(self, config, path, setup_new_collection=None):
+    def __init__(self, config, path, setup_new_collection=None, worker=None):
         self.path = path
         self.wrapper = get_collection_wrapper(config, path, setup_new_collection)
         self.logger = logging.getLogger("ankisyncd." + str(self))
 
-        self._queue = Queue()
-        self._thread = None
-        self._running = False
+        self._own_worker = worker is None
+        if self._own_worker:
+            worker = CollectionWorker(str(self))
+        self._worker = worker
         self.last_timestamp = time.time()
 
-        self.start()
+        # set by the ThreadingCollectionManager which owns this wrapper
+        self.manager = None
+        # once evicted, the collection is closed and further calls are passed
+        # on to the wrapper which replaces this one
+        self.evicted = False
+        # when the databases were last checkpointed
+        self._checkpointed = 0
+        self._stopped = Event()
+        self._pending = 0
+        self._lock = Lock()
 
     def __str__(self):
         return "CollectionThread[{}]".format(self.wrapper.username)
 
     @property
     def running(self):
-        return self._running
+        return not self.evicted
 
     def qempty(self):
-        return self._queue.empty()
+        return self._pending == 0
+
+    def queue_depth(self):
+        """Returns the number of calls waiting or running."""
+        return self._pending
 
     def current(self):
-        from threading import current_thread
-        return current_thread() == self._thread
+        return self._worker.current()
 
     def execute(self, func, args=[], kw={}, waitForReturn=True):
-        """ Executes a given function on this thread with the *args and **kw.
+        """ Executes a given function on the worker thread with the *args and
+        **kw.
 
         If 'waitForReturn' is True, then it will block until the function has
         executed and return its return value.  If False, it will return None
@@ -71,7 +117,15 @@ class ThreadingCollectionWrapper:
         else:
             return_queue = None
 
-        self._queue.put((func, args, kw, return_queue))
+        with self._lock:
+            evicted = self.evicted
+            if not evicted:
+                self.last_timestamp = time.time()
+                self._put(func, args, kw, return_queue)
+
+        if evicted:
+            col = self.manager.get_collection(self.path, self.wrapper.setup_new_collection)
+            return col.execute(func, args, kw, waitForReturn)
 
         if return_queue is not None:
             ret = return_queue.get(True)
@@ -79,59 +133,116 @@ class ThreadingCollectionWrapper:
                 raise ret
             return ret
 
-    def _run(self):
-        self.logger.info("Starting...")
+    def _put(self, func, args=[], kw={}, return_queue=None):
+        self._pending += 1
+        self._worker.put(self, func, args, kw, return_queue)
+
+    def _process(self, func, args, kw, return_queue, queued_at):
+        """Runs a queued function, called on the worker thread."""
+        if func is None:
+            self._finish()
+            return
+        if func is _CHECKPOINT:
+            self._checkpoint()
+            return
+
+        if hasattr(func, '__name__'):
+            func_name = func.__name__
+        else:
+            func_name = func.__class__.__name__
 
-        try:
-            while self._running:
-                func, args, kw, return_queue = self._queue.get(True)
+        self.logger.info("Running %s", func_name)
+        ankisyncd.log.debug_payload(self.logger, "Arguments: *%s, **%s", args, kw)
+        self.last_timestamp = time.time()
+        ankisyncd.metrics.queue_seconds.observe(func_name, time.monotonic() - queued_at)
 
-                if hasattr(func, '__name__'):
-                    func_name = func.__name__
-                else:
-                    func_name = func.__class__.__name__
+        try:
+            with ankisyncd.metrics.execute_seconds.time(func_name):
+                ret = self.wrapper.execute(func, args, kw, return_queue)
+        except Exception as e:
+            self.logger.error("Unable to %s(*%s, **%s): %s",
+                func_name, LazyRepr(args), LazyRepr(kw), e, exc_info=True)
+            # we return the Exception which will be raise'd on the other end
+            ret = e
 
-                self.logger.info("Running %s(*%s, **%s)", func_name, short_repr(args, self.logger), short_repr(kw, self.logger))
-                self.last_timestamp = time.time()
+        with self._lock:
+            self._pending -= 1
 
-                try:
-                    ret = self.wrapper.execute(func, args, kw, return_queue)
-                except Exception as e:
-                    self.logger.error("Unable to %s(*%s, **%s): %s",
-                        func_name, repr(args), repr(kw), e, exc_info=True)
-                    # we return the Exception which will be raise'd on the other end
-                    ret = e
+        if return_queue is not None:
+            return_queue.put(ret)
 
-                if return_queue is not None:
-                    return_queue.put(ret)
+    def _checkpoint(self):
+        try:
+            self.wrapper.checkpoint()
         except Exception as e:
-            self.logger.error("Thread crashed! Exception: %s", e, exc_info=True)
+            self.logger.error("Unable to checkpoint the collection: %s", e, exc_info=True)
         finally:
-            self.wrapper.close()
-            # clean out old thread object
-            self._thread = None
-            # in case we got here via an exception
-            self._running = False
+            with self._lock:
+                self._pending -= 1
 
+    def _finish(self):
+        try:
+            self.wrapper.close()
+        except Exception as e:
+            self.logger.error("Unable to close the collection: %s", e, exc_info=True)
+        finally:
+            with self._lock:
+                self._pending -= 1
+            if self._own_worker:
+                self._worker.stop()
+            self._stopped.set()
             self.logger.info("Stopped!")
 
-    def start(self):
-        if not self._running:
-            self._running = True
-            assert self._thread is None
-            self._thread = Thread(target=self._run)
-            self._thread.start()
-
     def stop(self):
-        def _stop(col):
-            self._running = False
-        self.execute(_stop, waitForReturn=False)
+        """Closes the collection after everything queued so far has run.
+        Further calls are passed on to a new wrapper."""
+        with self._lock:
+            if self.evicted:
+                return
+            self.evicted = True
+            self._put(None)
 
     def stop_and_wait(self):
         """ Tell the thread to stop and wait for it to happen. """
         self.stop()
-        if self._thread is not None:
-            self._thread.join()
+        self.join()
+
+    def join(self):
+        """Waits for the collection to be closed."""
+        self._stopped.wait()
+
+    def alive(self):
+        return not self._stopped.is_set()
+
+    def evict(self, min_idle=0, keep_syncing=False):
+        """Closes the collection, unless there's work queued for it, it has
+        been used in the last min_idle seconds, or a sync of it is in
+        progress. If keep_syncing is set, collections in the middle of an
+        incremental sync which isn't kept in a transaction are left open too.
+        Returns True if the wrapper was evicted."""
+        with self._lock:
+            if self.evicted or self._pending or time.time() - self.last_timestamp < min_idle:
+                return False
+            if self.wrapper.sync_in_progress():
+                return False
+            if keep_syncing and self.wrapper.syncing():
+                return False
+            self.evicted = True
+            self._put(None)
+        return True
+
+    def checkpoint(self, min_idle=0):
+        """Checkpoints the databases of the collection if it has been used
+        since the last checkpoint, but not in the last min_idle seconds.
+        Unlike other calls, this doesn't keep the collection from being
+        closed for inactivity. Returns True if a checkpoint was queued."""
+        with self._lock:
+            if self.evicted or self._pending or self._checkpointed >= self.last_timestamp \
+                    or time.time() - self.last_timestamp < min_idle:
+                return False
+            self._checkpointed = time.time()
+            self._put(_CHECKPOINT)
+        return True
 
     #
     # Mimic the CollectionWrapper interface
@@ -151,8 +262,27 @@ class ThreadingCollectionWrapper:
     def opened(self):
         return self.wrapper.opened()
 
+    def replace(self, path):
+        """Replaces the collection file on the collection's thread, after the
+        calls queued before."""
+        self.execute(WrapperCall("replace", path))
+
+def current_rss():
+    """Returns the resident set size of this process in bytes, or None if it
+    can't be determined on this platform."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
 class ThreadingCollectionManager(CollectionManager):
-    """Manages a set of ThreadingCollectionWrapper objects."""
+    """Manages a set of ThreadingCollectionWrapper objects.
+
+    Collections which haven't been used for a while are closed and their
+    threads are stopped. The number of open collections and the memory used
+    by the server can be limited, in which case the least recently used
+    collections are closed first to stay within the limits."""
 
     collection_wrapper = ThreadingCollectionWrapper
 
@@ -160,9 +290,27 @@ class ThreadingCollectionManager(CollectionManager):
         super(ThreadingCollectionManager, self).__init__(config)
 
         self.monitor_frequency = 15
-        self.monitor_inactivity = 90
+        self.monitor_inactivity = int(config.get('collection_idle_timeout', 90))
+        # 0 means no limit
+        self.max_open = int(config.get('collection_max_open', 0))
+        self.memory_budget = int(config.get('collection_memory_budget', 0)) * 1024 * 1024
+        # collections used more recently than that aren't closed to stay
+        # within the limits, the client may be about to make its next call
+        self.evict_min_idle = self.monitor_inactivity / 6
+        # 0 leaves checkpointing WAL databases to SQLite
+        sqlite_profile = get_sqlite_profile(config)
+        self.checkpoint_idle = sqlite_profile.checkpoint_idle if sqlite_profile.wal else 0
         self.logger = logging.getLogger("ankisyncd.ThreadingCollectionManager")
 
+        # 0 gives every collection a thread of its own
+        workers = int(config.get('collection_workers', 0))
+        self._workers = [CollectionWorker("CollectionWorker[%d]" % i) for i in range(workers)]
+
+        if self.memory_budget and current_rss() is None:
+            self.logger.warning("Can't determine memory usage on this platform, "
+                                "collection_memory_budget will be ignored")
+            self.memory_budget = 0
+
         monitor = Thread(target=self._monitor_run)
         monitor.daemon = True
         monitor.start()
@@ -171,18 +319,92 @@ class ThreadingCollectionManager(CollectionManager):
     # TODO: we should raise some error if a collection is started on a manager that has already been shutdown!
     #       or maybe we could support being restarted?
 
-    # TODO: it would be awesome to have a safe way to stop inactive threads completely!
-    # TODO: we need a way to inform other code that the collection has been closed
+    def get_collection(self, path, setup_new_collection=None):
+        """Gets a ThreadingCollectionWrapper for the given path, starting a
+        new one if there's none or the previous one was evicted."""
+
+        path = os.path.realpath(path)
+
+        while True:
+            with self._lock:
+                col = self.collections.get(path)
+                if col is None:
+                    self._make_room()
+                    col = self.collection_wrapper(self.config, path, setup_new_collection,
+                                                  worker=self._worker_for(path))
+                    col.manager = self
+                    self.collections[path] = col
+                if not col.evicted:
+                    # keeps the monitor from evicting it before it's used
+                    col.last_timestamp = time.time()
+                    return col
+
+            # the collection has to be closed before it's opened again
+            col.join()
+            with self._lock:
+                if self.collections.get(path) is col:
+                    del self.collections[path]
+
+    def _worker_for(self, path):
+        """Returns the shared worker for a collection, the same one every
+        time, so that calls for it still run in order after it's reopened."""
+        if not self._workers:
+            return None
+        return self._workers[zlib.crc32(path.encode()) % len(self._workers)]
+
+    def _active(self):
+        return [col for col in self.collections.values() if not col.evicted]
+
+    def _make_room(self):
+        """Evicts the least recently used collection if opening another one
+        would go over max_open. Must be called with self._lock held."""
+        if not self.max_open:
+            return
+
+        active = self._active()
+        if len(active) < self.max_open:
+            return
+        for col in sorted(active, key=lambda col: col.last_timestamp):
+            if col.evict(self.evict_min_idle, keep_syncing=True):
+                self.logger.info("Evicting least recently used %s", col)
+                return
+        self.logger.warning("All %d open collections are in use, going over "
+                            "collection_max_open", len(active))
+
+    def _enforce_memory_budget(self):
+        """Evicts the least recently used collections while the server uses
+        more memory than allowed. Must be called with self._lock held."""
+        rss = current_rss()
+        if not self.memory_budget or rss is None or rss <= self.memory_budget:
+            return
+
+        # memory freed by closing collections is rarely given back to the OS
+        # right away, so only a few are closed per round, and the RSS is
+        # measured again in the next one before any more are
+        active = self._active()
+        evictions = max(1, len(active) // 10)
+        for col in sorted(active, key=lambda col: col.last_timestamp):
+            if not evictions:
+                break
+            if col.evict(self.evict_min_idle, keep_syncing=True):
+                self.logger.info("Over memory budget (%d bytes used), evicting %s", rss, col)
+                evictions -= 1
+
     def _monitor_run(self):
-        """ Monitors threads for inactivity and closes the collection on them
-        (leaves the thread itself running -- hopefully waiting peacefully with only a
-        small memory footprint!) """
+        """ Monitors threads for inactivity, closes the collections and stops
+        the threads of inactive ones, checkpoints the databases of idle ones,
+        and keeps the server within its memory budget. """
         while True:
-            cur = time.time()
-            for path, thread in self.collections.items():
-                if thread.running and thread.wrapper.opened() and thread.qempty() and cur - thread.last_timestamp >= self.monitor_inactivity:
-                    self.logger.info("Monitor is closing collection on inactive %s", thread)
-                    thread.close()
+            with self._lock:
+                for path, col in list(self.collections.items()):
+                    if col.evicted:
+                        if not col.alive():
+                            del self.collections[path]
+                    elif col.evict(self.monitor_inactivity):
+                        self.logger.info("Monitor is closing collection on inactive %s", col)
+                    elif self.checkpoint_idle and col.checkpoint(self.checkpoint_idle):
+                        self.logger.debug("Monitor is checkpointing idle %s", col)
+                self._enforce_memory_budget()
             time.sleep(self.monitor_frequency)
 
     def shutdown(self):
@@ -192,6 +414,8 @@ class ThreadingCollectionManager(CollectionManager):
         for path, col in list(self.collections.items()):
             del self.collections[path]
             col.stop()
+        for worker in self._workers:
+            worker.stop()
 
         # let the parent do whatever else it might want to do...
         super(ThreadingCollectionManager, self).shutdown()
@@ -203,10 +427,15 @@ class ThreadingCollectionManager(CollectionManager):
 collection_manager = None
 
 def get_collection_manager(config):
-    """Return the global ThreadingCollectionManager for this process."""
+    """Return the global ThreadingCollectionManager for this process, or a
+    ProcessCollectionManager if collection_processes is set."""
     global collection_manager
     if collection_manager is None:
-        collection_manager = ThreadingCollectionManager(config)
+        if int(config.get('collection_processes', 0)):
+            from ankisyncd.process import ProcessCollectionManager
+            collection_manager = ProcessCollectionManager(config)
+        else:
+            collection_manager = ThreadingCollectionManager(config)
     return collection_manager
 
 def shutdown():
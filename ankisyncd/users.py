@@ -4,6 +4,8 @@ import hashlib
 import logging
 import os
 import sqlite3 as sqlite
+import threading
+import time
 
 logger = logging.getLogger("ankisyncd.users")
 
@@ -40,25 +42,33 @@ class SimpleUserManager:
 
 
 class SqliteUserManager(SimpleUserManager):
-    """Authenticates users against a SQLite database."""
+    """Authenticates users against a SQLite database.
 
-    def __init__(self, auth_db_path, collection_path=None):
+    If auth_cache_ttl is set, successful logins are remembered for that many
+    seconds, so that repeated logins of the same user don't hit the database.
+    Changing the password or deleting the user through this object forgets
+    them immediately."""
+
+    def __init__(self, auth_db_path, collection_path=None, auth_cache_ttl=0):
         SimpleUserManager.__init__(self, collection_path)
 
         self.auth_db_path = os.path.realpath(auth_db_path)
+        self.auth_cache_ttl = auth_cache_ttl
+        # username -> (password hash, expiry time)
+        self._auth_cache = {}
+        self._local = threading.local()
         self._ensure_schema_up_to_date()
 
     def _ensure_schema_up_to_date(self):
         if not self.auth_db_exists():
             return True
 
-        conn = self._conn()
+        conn = self._cached_conn()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM sqlite_master "
                        "WHERE sql LIKE '%user VARCHAR PRIMARY KEY%' "
                        "AND tbl_name = 'auth'")
         res = cursor.fetchone()
-        conn.close()
         if res is not None:
             raise Exception("Outdated database schema, run utils/migrate_user_tables.py")
 
@@ -72,6 +82,25 @@ class SqliteUserManager(SimpleUserManager):
     def _conn(self):
         return sqlite.connect(self.auth_db_path)
 
+    def _cached_conn(self):
+        # every thread keeps the connection _conn() opened for it, sqlite3
+        # connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and not self.auth_db_exists():
+            # the database has been removed under us
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self._local.conn = self._conn()
+        return conn
+
+    def close(self):
+        """Closes the calling thread's database connection."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
     # Default to using sqlite3 syntax but overridable for sub-classes using other
     # DB API 2 driver variants
     @staticmethod
@@ -82,30 +111,34 @@ class SqliteUserManager(SimpleUserManager):
         if not self.auth_db_exists():
             raise ValueError("Auth DB {} doesn't exist".format(self.auth_db_path))
 
-        conn = self._conn()
+        conn = self._cached_conn()
         cursor = conn.cursor()
         cursor.execute(self.fs("SELECT username FROM auth"))
         rows = cursor.fetchall()
         conn.commit()
-        conn.close()
 
         return [row[0] for row in rows]
 
     def user_exists(self, username):
-        users = self.user_list()
-        return username in users
+        if not self.auth_db_exists():
+            raise ValueError("Auth DB {} doesn't exist".format(self.auth_db_path))
+
+        conn = self._cached_conn()
+        cursor = conn.cursor()
+        cursor.execute(self.fs("SELECT 1 FROM auth WHERE username=?"), (username,))
+        return cursor.fetchone() is not None
 
     def del_user(self, username):
         # Warning, this doesn't remove the user directory or clean it
         if not self.auth_db_exists():
             raise ValueError("Auth DB {} doesn't exist".format(self.auth_db_path))
 
-        conn = self._conn()
+        conn = self._cached_conn()
         cursor = conn.cursor()
         logger.info("Removing user '{}' from auth db".format(username))
         cursor.execute(self.fs("DELETE FROM auth WHERE username=?"), (username,))
         conn.commit()
-        conn.close()
+        self._auth_cache.pop(username, None)
 
     def add_user(self, username, password):
         self._add_user_to_auth_db(username, password)
@@ -121,13 +154,12 @@ class SqliteUserManager(SimpleUserManager):
 
         pass_hash = self._create_pass_hash(username, password)
 
-        conn = self._conn()
+        conn = self._cached_conn()
         cursor = conn.cursor()
         logger.info("Adding user '{}' to auth db.".format(username))
         cursor.execute(self.fs("INSERT INTO auth VALUES (?, ?)"),
                        (username, pass_hash))
         conn.commit()
-        conn.close()
 
     def set_password_for_user(self, username, new_password):
         if not self.auth_db_exists():
@@ -137,30 +169,37 @@ class SqliteUserManager(SimpleUserManager):
 
         hash = self._create_pass_hash(username, new_password)
 
-        conn = self._conn()
+        conn = self._cached_conn()
         cursor = conn.cursor()
         cursor.execute(self.fs("UPDATE auth SET hash=? WHERE username=?"), (hash, username))
         conn.commit()
-        conn.close()
+        self._auth_cache.pop(username, None)
 
         logger.info("Changed password for user {}".format(username))
 
     def authenticate(self, username, password):
         """Returns True if this username is allowed to connect with this password. False otherwise."""
 
-        conn = self._conn()
-        cursor = conn.cursor()
-        param = (username,)
-        cursor.execute(self.fs("SELECT hash FROM auth WHERE username=?"), param)
-        db_hash = cursor.fetchone()
-        conn.close()
-
-        if db_hash is None:
-            logger.info("Authentication failed for nonexistent user {}."
-                         .format(username))
-            return False
+        cached = self._auth_cache.get(username)
+        if cached is not None and cached[1] <= time.time():
+            cached = None
+
+        if cached is not None:
+            expected_value = cached[0]
+        else:
+            conn = self._cached_conn()
+            cursor = conn.cursor()
+            param = (username,)
+            cursor.execute(self.fs("SELECT hash FROM auth WHERE username=?"), param)
+            db_hash = cursor.fetchone()
+
+            if db_hash is None:
+                logger.info("Authentication failed for nonexistent user {}."
+                             .format(username))
+                return False
+
+            expected_value = str(db_hash[0])
 
-        expected_value = str(db_hash[0])
         salt = self._extract_salt(expected_value)
 
         hashobj = hashlib.sha256()
@@ -169,6 +208,10 @@ class SqliteUserManager(SimpleUserManager):
 
         if actual_value == expected_value:
             logger.info("Authentication succeeded for user {}".format(username))
+            # the expiry isn't extended on cache hits, so that password
+            # changes made by other processes are picked up eventually
+            if self.auth_cache_ttl and cached is None:
+                self._auth_cache[username] = (expected_value, time.time() + self.auth_cache_ttl)
             return True
         else:
             logger.info("Authentication failed for user {}".format(username))
@@ -186,20 +229,20 @@ class SqliteUserManager(SimpleUserManager):
         return pass_hash
 
     def create_auth_db(self):
-        conn = self._conn()
+        conn = self._cached_conn()
         cursor = conn.cursor()
         logger.info("Creating auth db at {}."
                      .format(self.auth_db_path))
         cursor.execute(self.fs("""CREATE TABLE IF NOT EXISTS auth
                           (username VARCHAR PRIMARY KEY, hash VARCHAR)"""))
         conn.commit()
-        conn.close()
 
 
 def get_user_manager(config):
     if "auth_db_path" in config and config["auth_db_path"]:
         logger.info("Found auth_db_path in config, using SqliteUserManager for auth")
-        return SqliteUserManager(config['auth_db_path'], config['data_root'])
+        return SqliteUserManager(config['auth_db_path'], config['data_root'],
+                                 float(config.get('auth_cache_ttl') or 0))
     elif "user_manager" in config and config["user_manager"]:  # load from config
         logger.info("Found user_manager in config, using {} for auth".format(config['user_manager']))
         import importlib
@@ -4,7 +4,7 @@ import os
 import unittest
 import configparser
 
-from ankisyncd.collection import CollectionWrapper
+from ankisyncd.collection import CollectionWrapper, USN_INDEXES
 from ankisyncd.collection import get_collection_wrapper
 
 import helpers.server_utils
@@ -45,3 +45,49 @@ class CollectionWrapperFactoryTest(unittest.TestCase):
         with self.assertRaises(TypeError):
             pm = get_collection_wrapper(config['sync_app'], path)
 
+
+class FakeCollection:
+    def __init__(self):
+        self.db = object()
+
+    def close(self):
+        self.db = None
+
+class CountingCollectionWrapper(CollectionWrapper):
+    opened_count = 0
+
+    def _get_collection(self):
+        self.opened_count += 1
+        return FakeCollection()
+
+class CollectionWrapperTest(unittest.TestCase):
+    def test_replace(self):
+        server_paths = helpers.server_utils.create_server_paths()
+        path = os.path.join(server_paths['data_root'], 'collection.anki2')
+        open(path, 'w').close()
+        wrapper = CountingCollectionWrapper({}, path)
+        wrapper.open()
+
+        # e.g. a full upload
+        with open(path + '.tmp', 'w') as f:
+            f.write('uploaded')
+        wrapper.replace(path + '.tmp')
+        self.assertFalse(wrapper.opened())
+        self.assertEqual(wrapper.opened_count, 1)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'uploaded')
+
+        # it's reopened on the next use only
+        self.assertIsNotNone(wrapper.execute(lambda col: col.db))
+        self.assertEqual(wrapper.opened_count, 2)
+
+    def test_usn_indexes(self):
+        server_paths = helpers.server_utils.create_server_paths()
+        path = os.path.join(server_paths['data_root'], 'collection.anki2')
+        wrapper = CollectionWrapper({}, path)
+
+        indexes = wrapper.execute(lambda col: col.db.list(
+            "select name from sqlite_master where type = 'index'"))
+        for name, table in USN_INDEXES:
+            self.assertIn(name, indexes)
+        wrapper.close()
@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import os
+import shutil
+import sqlite3
+import tempfile
+import types
 import unittest
 import configparser
+import gzip
+import io
+
+from webob.exc import HTTPBadRequest
 
 from ankisyncd.full_sync import FullSyncManager, get_full_sync_manager
 
@@ -42,3 +50,104 @@ class FullSyncManagerFactoryTest(unittest.TestCase):
         with self.assertRaises(TypeError):
             pm = get_full_sync_manager(config['sync_app'])
 
+
+
+class FullSyncManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.data_root = tempfile.mkdtemp(prefix="ankisyncd-full-sync-")
+        self.addCleanup(shutil.rmtree, self.data_root)
+        user_path = os.path.join(self.data_root, "user")
+        os.mkdir(user_path)
+        self.col_path = os.path.join(user_path, "collection.anki2")
+        self.session = types.SimpleNamespace(
+            name="user", get_collection_path=lambda: self.col_path)
+
+        conn = sqlite3.connect(self.col_path)
+        conn.execute("pragma journal_mode = wal")
+        conn.execute("create table graves (usn integer, oid integer, type integer)")
+        conn.execute("create index ix_graves_usn on graves (usn)")
+        conn.execute("insert into graves values (1, 1, 0)")
+        conn.commit()
+        conn.close()
+
+    def user_files(self):
+        return sorted(os.listdir(os.path.dirname(self.col_path)))
+
+    def test_download_snapshot(self):
+        # a sync in progress, its changes aren't committed yet
+        conn = sqlite3.connect(self.col_path)
+        self.addCleanup(conn.close)
+        conn.execute("insert into graves values (2, 2, 0)")
+
+        response = FullSyncManager().download(None, self.session)
+        conn.commit()
+        data = b"".join(response.app_iter)
+        self.assertEqual(len(data), response.content_length)
+
+        snapshot_path = os.path.join(self.data_root, "snapshot.anki2")
+        with open(snapshot_path, "wb") as f:
+            f.write(data)
+        snapshot = sqlite3.connect(snapshot_path)
+        self.addCleanup(snapshot.close)
+        self.assertEqual(snapshot.execute("select oid from graves").fetchall(), [(1,)])
+        self.assertEqual(snapshot.execute("pragma journal_mode").fetchone()[0], "delete")
+        # server-only indexes aren't sent to the client
+        self.assertIsNone(snapshot.execute("select name from sqlite_master "
+                                           "where name = 'ix_graves_usn'").fetchone())
+
+        self.assertEqual(len([name for name in self.user_files() if name.endswith(".download")]), 1)
+        response.app_iter.close()
+        self.assertFalse([name for name in self.user_files() if name.endswith(".download")])
+
+    def test_remove_stale_snapshots(self):
+        FullSyncManager().download(None, self.session)
+        self.assertTrue([name for name in self.user_files() if name.endswith(".download")])
+
+        FullSyncManager().remove_stale_snapshots(self.data_root)
+        self.assertFalse([name for name in self.user_files() if name.endswith(".download")])
+        self.assertIn("collection.anki2", self.user_files())
+
+    def upload(self, manager, data):
+        wrapper = types.SimpleNamespace(replace=lambda path: os.replace(path, self.col_path))
+        return manager.upload(wrapper, data, self.session)
+
+    def test_upload_spooled(self):
+        with open(self.col_path, "rb") as f:
+            uploaded = f.read()
+        os.unlink(self.col_path)
+
+        manager = FullSyncManager()
+        # read in several chunks, like the gunzipped request body
+        manager.upload_chunk_size = 1000
+        data = gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(uploaded)))
+        self.assertEqual(self.upload(manager, data), "OK")
+
+        with open(self.col_path, "rb") as f:
+            self.assertEqual(f.read(), uploaded)
+        self.assertEqual(self.user_files(), ["collection.anki2"])
+
+    def test_upload_quick_check(self):
+        manager = FullSyncManager({"full_sync_integrity_check": "quick_check"})
+        self.assertEqual(manager.integrity_check, "quick_check")
+        with open(self.col_path, "rb") as f:
+            self.assertEqual(self.upload(manager, f), "OK")
+
+    def test_upload_invalid_integrity_check(self):
+        with self.assertRaises(ValueError):
+            FullSyncManager({"full_sync_integrity_check": "drop table cards"})
+
+    def test_upload_corrupt(self):
+        with open(self.col_path, "rb") as f:
+            original = f.read()
+
+        with self.assertRaises(HTTPBadRequest):
+            self.upload(FullSyncManager(), b"not a database" * 1000)
+
+        # neither replaced nor left behind
+        self.assertEqual(self.user_files(), ["collection.anki2"])
+        with open(self.col_path, "rb") as f:
+            self.assertEqual(f.read(), original)
+
+    def test_integrity_check_without_init(self):
+        # subclasses don't have to call FullSyncManager.__init__()
+        self.assertEqual(FakeFullSyncManager(None).integrity_check, "integrity_check")
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import ankisyncd.log
+from ankisyncd.log import LazyRepr
+
+
+class LogTest(unittest.TestCase):
+    def test_lazy_repr(self):
+        self.assertEqual(str(LazyRepr({"a": 1})), "{'a': 1}")
+
+        old = ankisyncd.log.payload_max_length
+        try:
+            ankisyncd.log.payload_max_length = 5
+            self.assertEqual(str(LazyRepr("x" * 20)), "'xxxx... (22 characters)")
+        finally:
+            ankisyncd.log.payload_max_length = old
+
+    def test_start_request(self):
+        self.assertEqual(ankisyncd.log.start_request("abc-123"), "abc-123")
+        self.assertEqual(ankisyncd.log.request_id.get(), "abc-123")
+
+        rid = ankisyncd.log.start_request("forged\nlog line")
+        self.assertRegex(rid, r"^[0-9a-f]{12}$")
+        self.assertNotEqual(ankisyncd.log.start_request(), rid)
@@ -42,6 +42,7 @@ class ServerMediaManagerTest(unittest.TestCase):
         )
         self.assertEqual(cm.lastUsn(), sm.lastUsn())
         self.assertEqual(list(sm.db.execute("SELECT usn FROM media")), [(161,), (161,)])
+        self.assertEqual(sm.mediaCount(), 2)
 
     def test_mediaChanges_lastUsn_order(self):
         col = self.colutils.create_empty_col()
@@ -57,3 +58,88 @@ class ServerMediaManagerTest(unittest.TestCase):
         # anki assumes mh.col.media.lastUsn() == mh.mediaChanges()['data'][-1][1]
         # ref: anki/sync.py:720 (commit cca3fcb2418880d0430a5c5c2e6b81ba260065b7)
         self.assertEqual(mh.mediaChanges(lastUsn=99)['data'][-1][1], mh.col.media.lastUsn())
+
+    def test_mediaChanges_pages(self):
+        col = self.colutils.create_empty_col()
+        col.media = ankisyncd.media.ServerMediaManager(col)
+        mh = ankisyncd.sync_app.SyncMediaHandler(col, {'media_changes_page_size': '2'})
+        mh.col.media.db.execute("""
+            INSERT INTO media (fname, usn, csum)
+            VALUES ('fileA', 5, NULL), ('fileB', 7, 'b'), ('fileC', 7, 'c'), ('fileD', 8, 'd')
+        """)
+
+        # files sharing a USN aren't split between pages
+        self.assertEqual(mh.mediaChanges(lastUsn=0)['data'][0], ['fileA', 5, None])
+        self.assertEqual(sorted(mh.mediaChanges(lastUsn=0)['data'][1:]),
+                         [['fileB', 7, 'b'], ['fileC', 7, 'c']])
+        self.assertEqual(sorted(mh.mediaChanges(lastUsn=5)['data']),
+                         [['fileB', 7, 'b'], ['fileC', 7, 'c']])
+        self.assertEqual(mh.mediaChanges(lastUsn=7)['data'], [['fileD', 8, 'd']])
+        self.assertEqual(mh.mediaChanges(lastUsn=8)['data'], [])
+
+    def test_lastUsn_counter(self):
+        col = self.colutils.create_empty_col()
+        col.media = ankisyncd.media.ServerMediaManager(col)
+        sm = col.media
+        self.assertEqual(sm.lastUsn(), 0)
+
+        sm.syncAdd([("fileA", "53059abba1a72c7aff34a3eaf7fef10ed65541ce"),
+                    ("fileB", "a5ae546046d09559399c80fa7076fb10f1ce4bcd")])
+        sm.db.commit()
+        self.assertEqual(list(sm.db.execute("SELECT fname, usn FROM media ORDER BY usn")),
+                         [("fileA", 1), ("fileB", 2)])
+        self.assertEqual(sm.lastUsn(), 2)
+
+        # deleting an unknown file doesn't use up a USN
+        sm.syncDelete("fileC")
+        self.assertEqual(sm.lastUsn(), 2)
+        sm.syncDelete("fileA")
+        self.assertEqual(sm.lastUsn(), 3)
+        sm.db.commit()
+
+        # writes bypassing the media manager are noticed
+        sm.db.execute("UPDATE media SET usn = 10 WHERE fname = 'fileB'")
+        self.assertEqual(sm.lastUsn(), 10)
+
+        sm.close()
+        sm.connect()
+        self.assertEqual(sm.lastUsn(), 10)
+
+    def test_lastUsn_after_rollback(self):
+        col = self.colutils.create_empty_col()
+        col.media = ankisyncd.media.ServerMediaManager(col)
+        sm = col.media
+
+        sm.syncAdd([("fileA", "a")])
+        sm.db.commit()
+        sm.syncAdd([("fileB", "b"), ("fileC", "c")])
+        self.assertEqual(sm.lastUsn(), 3)
+
+        # the rolled back USNs are handed out again, clients don't see a gap
+        sm.rollback()
+        self.assertEqual(sm.lastUsn(), 1)
+        sm.syncAdd([("fileB", "b")])
+        sm.db.commit()
+        self.assertEqual(sm.db.scalar("SELECT usn FROM media WHERE fname = 'fileB'"), 2)
+
+    def test_syncDeleteMany(self):
+        col = self.colutils.create_empty_col()
+        col.media = ankisyncd.media.ServerMediaManager(col)
+        sm = col.media
+
+        fnames = ["file%d" % i for i in range(1200)]
+        for fname in fnames:
+            with open(os.path.join(sm.dir(), fname), "w") as f:
+                f.write(fname)
+        sm.syncAdd([(fname, "csum") for fname in fnames])
+        sm.db.commit()
+        self.assertEqual(sm.lastUsn(), 1200)
+
+        sm.syncDeleteMany(fnames[:1000] + ["unknown"])
+
+        self.assertEqual(sm.lastUsn(), 2200)
+        self.assertEqual(sm.mediaCount(), 200)
+        self.assertEqual(sm.syncInfo("file0"), (None, 0))
+        self.assertEqual(sm.db.scalar("SELECT usn FROM media WHERE fname = 'file999'"), 2200)
+        self.assertFalse(os.path.exists(os.path.join(sm.dir(), "file0")))
+        self.assertTrue(os.path.exists(os.path.join(sm.dir(), "file1000")))
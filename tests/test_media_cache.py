@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from ankisyncd.media_cache import MediaBlobCache
+from ankisyncd.media_zip import stream_zip
+
+
+class MediaBlobCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="ankisyncd-media-cache-")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        cache = MediaBlobCache(self.path, 1024 * 1024)
+        self.assertIsNone(cache.get("aa11"))
+
+        blob = cache.put("aa11", io.BytesIO(b"abc" * 1000))
+        blob.data.close()
+        blob = cache.get("aa11")
+        with blob.data:
+            self.assertEqual(blob.file_size, 3000)
+            self.assertEqual(len(blob.data.read()), blob.compress_size)
+
+        # survives a restart
+        self.assertIn("aa11", MediaBlobCache(self.path, 1024 * 1024)._entries)
+
+    def test_lru_eviction(self):
+        cache = MediaBlobCache(self.path, 2500)
+        for csum in ("aa11", "bb22", "cc33"):
+            cache.put(csum, io.BytesIO(os.urandom(1000))).data.close()
+
+        self.assertIsNone(cache.get("aa11"))
+        cache.get("bb22").data.close()
+        cache.put("dd44", io.BytesIO(os.urandom(1000))).data.close()
+
+        self.assertIsNone(cache.get("cc33"))
+        self.assertLessEqual(cache._size, 2500)
+        self.assertEqual(list(cache._entries), ["bb22", "dd44"])
+
+    def test_stream_zip_splices_cached_blobs(self):
+        cache = MediaBlobCache(self.path, 1024 * 1024)
+        content = b"hello " * 1000
+
+        for _ in range(2):
+            members = [
+                ("0", io.BytesIO(content), len(content), zipfile.ZIP_DEFLATED, "aa11"),
+                ("_meta", b'{"0": "a.txt"}', 14, zipfile.ZIP_DEFLATED, None),
+            ]
+            data = b"".join(stream_zip(members, cache=cache))
+            with zipfile.ZipFile(io.BytesIO(data)) as z:
+                self.assertIsNone(z.testzip())
+                self.assertEqual(z.read("0"), content)
+
+        self.assertEqual(list(cache._entries), ["aa11"])
+
+    def test_stream_zip_blob_larger_than_cache(self):
+        cache = MediaBlobCache(self.path, 100)
+        content = os.urandom(5000)
+
+        members = [("0", io.BytesIO(content), len(content), zipfile.ZIP_DEFLATED, "aa11")]
+        data = b"".join(stream_zip(members, cache=cache))
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(z.read("0"), content)
+
+        self.assertEqual(list(cache._entries), [])
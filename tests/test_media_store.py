@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from ankisyncd.media_store import MediaBlobStore
+
+
+class MediaBlobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="ankisyncd-media-store-")
+        self.store = MediaBlobStore(os.path.join(self.root, "store"))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_media(self, user, fname, data):
+        media_dir = os.path.join(self.root, user)
+        os.makedirs(media_dir, exist_ok=True)
+        path = os.path.join(media_dir, fname)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_add_and_gc(self):
+        data = b"shared audio"
+        csum = hashlib.sha1(data).hexdigest()
+        paths = [self.write_media(user, "a.mp3", data) for user in ("u1", "u2")]
+        for path in paths:
+            self.assertTrue(self.store.add(path, csum))
+
+        self.assertEqual(os.stat(paths[0]).st_ino, os.stat(paths[1]).st_ino)
+        self.assertEqual(os.stat(paths[0]).st_nlink, 3)
+
+        os.remove(paths[0])
+        self.assertEqual(self.store.gc(), 0)
+        os.remove(paths[1])
+        self.assertEqual(self.store.gc(), 1)
+        self.assertFalse(os.path.exists(self.store._blob_path(csum)))
+
+    def test_add_dir(self):
+        self.write_media("u1", "a.jpg", b"image")
+        path = self.write_media("u2", "b.jpg", b"image")
+
+        self.assertEqual(self.store.add_dir(os.path.join(self.root, "u1")), 1)
+        self.assertEqual(self.store.add_dir(os.path.join(self.root, "u2")), 1)
+        self.assertEqual(self.store.add_dir(os.path.join(self.root, "u2")), 0)
+        self.assertEqual(os.stat(path).st_nlink, 3)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import io
+import unittest
+import zipfile
+
+from ankisyncd.media_zip import compress_type, stream_zip
+
+
+class CompressTypeTest(unittest.TestCase):
+    def test_extensions(self):
+        for fname in ("a.jpg", "b.JPEG", "c.mp3", "d.png", "e.ogg", "f.mp4", "g.webm"):
+            self.assertEqual(compress_type(fname), zipfile.ZIP_STORED, fname)
+        for fname in ("a.txt", "b.svg", "c.wav", "d.css", "e"):
+            self.assertEqual(compress_type(fname), zipfile.ZIP_DEFLATED, fname)
+
+    def test_signatures(self):
+        # compressed formats with misleading or missing extensions
+        self.assertEqual(compress_type("a.dat", b"\xff\xd8\xff\xe0\x00\x10JFIF"), zipfile.ZIP_STORED)
+        self.assertEqual(compress_type("b", b"ID3\x04\x00"), zipfile.ZIP_STORED)
+        self.assertEqual(compress_type("c.bin", b"\x00\x00\x00\x18ftypmp42"), zipfile.ZIP_STORED)
+        self.assertEqual(compress_type("d.img", b"RIFF\x00\x00\x00\x00WEBPVP8 "), zipfile.ZIP_STORED)
+        # WAV is RIFF too, but not compressed
+        self.assertEqual(compress_type("e.dat", b"RIFF\x00\x00\x00\x00WAVEfmt "), zipfile.ZIP_DEFLATED)
+        self.assertEqual(compress_type("f.dat", b"<html><body>"), zipfile.ZIP_DEFLATED)
+
+
+class StreamZipTest(unittest.TestCase):
+    def members(self):
+        return [
+            ("0", io.BytesIO(b"hello" * 1000), 5000, zipfile.ZIP_DEFLATED, None),
+            ("1", io.BytesIO(b"world" * 1000), 5000, zipfile.ZIP_STORED, None),
+            ("_meta", b'{"0": "a.txt", "1": "b.txt"}', 28, zipfile.ZIP_DEFLATED, None),
+        ]
+
+    def test_round_trip(self):
+        data = b"".join(stream_zip(self.members(), chunk_size=1000))
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(z.read("0"), b"hello" * 1000)
+            self.assertEqual(z.read("1"), b"world" * 1000)
+
+    def test_close_before_iterating(self):
+        members = self.members()
+        # e.g. the client went away before the response was started
+        stream_zip(members).close()
+        self.assertTrue(members[0][1].closed)
+        self.assertTrue(members[1][1].closed)
+
+    def test_close_while_iterating(self):
+        members = self.members()
+        body = stream_zip(members, chunk_size=100)
+        next(iter(body))
+        body.close()
+        self.assertTrue(members[0][1].closed)
+        self.assertTrue(members[1][1].closed)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import types
+import unittest
+
+import ankisyncd.metrics
+from ankisyncd.metrics import Counter, Histogram, MetricsMiddleware, Registry
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self):
+        h = Histogram("test_seconds", "Test.", buckets=(0.1, 1))
+        h.observe("meta", 0.05)
+        h.observe("meta", 0.5)
+        h.observe("meta", 5)
+
+        self.assertEqual(h.render(), [
+            "# HELP test_seconds Test.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{operation="meta",le="0.1"} 1',
+            'test_seconds_bucket{operation="meta",le="1"} 2',
+            'test_seconds_bucket{operation="meta",le="+Inf"} 3',
+            'test_seconds_sum{operation="meta"} 5.55',
+            'test_seconds_count{operation="meta"} 3',
+        ])
+
+    def test_registry(self):
+        registry = Registry()
+        counter = registry.register(Counter("test_bytes_total", "Test."))
+        counter.inc("upload", 10)
+        counter.inc("upload", 5)
+        counter.inc('we"ird')
+        statuses = registry.register(Counter("test_total", "Test.", label=("operation", "status")))
+        statuses.inc(("meta", "200"))
+
+        self.assertEqual(registry.render(), "\n".join([
+            "# HELP test_bytes_total Test.",
+            "# TYPE test_bytes_total counter",
+            'test_bytes_total{operation="upload"} 15',
+            'test_bytes_total{operation="we\\"ird"} 1',
+            "# HELP test_total Test.",
+            "# TYPE test_total counter",
+            'test_total{operation="meta",status="200"} 1',
+        ]) + "\n")
+
+
+class FakeBody:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSyncApp:
+    valid_urls = ["meta", "upload"]
+    base_url = "/sync/"
+    base_media_url = "/msync/"
+
+    def __init__(self):
+        self.collection_manager = types.SimpleNamespace(collections={
+            "a": types.SimpleNamespace(evicted=False),
+            "b": types.SimpleNamespace(evicted=True),
+            "c": types.SimpleNamespace(opened=lambda: True),
+            "d": types.SimpleNamespace(opened=lambda: False),
+        })
+        self.status = "200 OK"
+        self.body = None
+
+    def __call__(self, environ, start_response):
+        if self.status is None:
+            raise RuntimeError("failed on purpose")
+        start_response(self.status, [])
+        return self.body
+
+
+class MetricsMiddlewareTest(unittest.TestCase):
+    def setUp(self):
+        self.app = FakeSyncApp()
+        self.middleware = MetricsMiddleware(self.app, "/metrics")
+
+    def request(self, path, content_length=0):
+        environ = {"PATH_INFO": path, "CONTENT_LENGTH": str(content_length)}
+        body = self.middleware(environ, lambda status, headers, exc_info=None: None)
+        try:
+            return b"".join(body)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+    def count(self, operation):
+        return sum(ankisyncd.metrics.request_seconds._values.get(operation, ([], 0))[0])
+
+    def test_request(self):
+        requests = ankisyncd.metrics.requests_total._values.get(("meta", "200"), 0)
+        count = self.count("meta")
+        request_bytes = ankisyncd.metrics.request_bytes._values.get("meta", 0)
+        response_bytes = ankisyncd.metrics.response_bytes._values.get("meta", 0)
+
+        self.app.body = FakeBody([b"hello", b"world"])
+        self.assertEqual(self.request("/sync/meta", 7), b"helloworld")
+
+        # the wrapped body is closed, and the request recorded
+        self.assertTrue(self.app.body.closed)
+        self.assertEqual(ankisyncd.metrics.requests_total._values[("meta", "200")], requests + 1)
+        self.assertEqual(self.count("meta"), count + 1)
+        self.assertEqual(ankisyncd.metrics.request_bytes._values["meta"], request_bytes + 7)
+        self.assertEqual(ankisyncd.metrics.response_bytes._values["meta"], response_bytes + 10)
+
+    def test_status(self):
+        requests = ankisyncd.metrics.requests_total._values.get(("upload", "403"), 0)
+        self.app.status = "403 Forbidden"
+        self.app.body = [b""]
+        self.request("/sync/upload")
+        self.assertEqual(ankisyncd.metrics.requests_total._values[("upload", "403")], requests + 1)
+
+        requests = ankisyncd.metrics.requests_total._values.get(("other", "500"), 0)
+        self.app.status = None
+        with self.assertRaises(RuntimeError):
+            self.request("/sync/unknown")
+        self.assertEqual(ankisyncd.metrics.requests_total._values[("other", "500")], requests + 1)
+
+    def test_metrics_url(self):
+        self.app.status = None
+        body = self.request("/metrics").decode()
+
+        self.assertIn("# TYPE ankisyncd_requests_total counter\n", body)
+        # evicted wrappers and closed collections aren't counted
+        self.assertIn("\nankisyncd_open_collections 2\n", body)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import types
+import unittest
+from multiprocessing import Pipe
+
+from webob import Response
+
+from ankisyncd.collection import CollectionWrapper
+from ankisyncd.process import HashRing, ProcessCollectionManager, _Pickler, _Worker
+
+
+class FakeCollection:
+    def __init__(self, path):
+        self.path = path
+        self.db = object()
+
+    def close(self, save=True):
+        self.db = None
+
+class FakeCollectionWrapper(CollectionWrapper):
+    # collections opened by this process
+    opened_paths = []
+
+    def _get_collection(self):
+        self.opened_paths.append(self.path)
+        return FakeCollection(self.path)
+
+
+def collection_info(col, data=None):
+    return os.getpid(), col.path, data.read() if data is not None else None
+
+def fail(col):
+    raise ValueError("failed on purpose")
+
+def respond(col):
+    return Response(app_iter=iter([b"a", b"b"]))
+
+
+class HashRingTest(unittest.TestCase):
+    def test_consistent(self):
+        keys = ["/data/user%d/collection.anki2" % i for i in range(1000)]
+        ring = HashRing(range(4))
+        nodes = {key: ring.get(key) for key in keys}
+
+        self.assertEqual(set(nodes.values()), {0, 1, 2, 3})
+        self.assertEqual(nodes, {key: HashRing(range(4)).get(key) for key in keys})
+
+        # adding a node only moves keys to the new node
+        bigger = HashRing(range(5))
+        moved = [key for key in keys if bigger.get(key) != nodes[key]]
+        self.assertTrue(all(bigger.get(key) == 4 for key in moved))
+        self.assertLess(len(moved), len(keys) / 3)
+
+
+class CollectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_root = tempfile.mkdtemp(prefix="ankisyncd-process-")
+
+    def tearDown(self):
+        shutil.rmtree(self.data_root)
+
+    def path(self, name):
+        path = os.path.join(self.data_root, name, "collection.anki2")
+        os.makedirs(os.path.dirname(path))
+        open(path, "w").close()
+        return os.path.realpath(path)
+
+
+class ProcessCollectionManagerTest(CollectionTestCase):
+    config = {
+        'collection_wrapper': 'test_process.FakeCollectionWrapper',
+        'collection_processes': '2',
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.manager = ProcessCollectionManager(self.config)
+
+    def tearDown(self):
+        self.manager.shutdown()
+        super().tearDown()
+
+    def test_round_trip(self):
+        path = self.path("a")
+        col = self.manager.get_collection(path)
+
+        pid, col_path, data = col.execute(collection_info, [io.BytesIO(b"payload")])
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(col_path, path)
+        self.assertEqual(data, b"payload")
+        # the spooled copy of the file is gone
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["collection.anki2"])
+
+        # calls for the same collection go to the same process
+        self.assertEqual(col.execute(collection_info)[0], pid)
+
+        self.assertEqual(col.execute(respond).body, b"ab")
+
+        with open(path + ".tmp", "w") as f:
+            f.write("uploaded")
+        col.replace(path + ".tmp")
+        with open(path) as f:
+            self.assertEqual(f.read(), "uploaded")
+
+    def test_forget_closed(self):
+        path = self.path("a")
+        col = self.manager.get_collection(path)
+        other = self.manager.get_collection(self.path("b"))
+
+        # the worker process reports the collections it has closed with the
+        # result of the next call
+        col.worker = types.SimpleNamespace(
+            call=lambda data, name: pickle.dumps((None, [other.path])))
+        col.execute(collection_info)
+        self.assertEqual(list(self.manager.collections), [path])
+
+    def test_errors(self):
+        col = self.manager.get_collection(self.path("a"))
+        with self.assertRaises(ValueError):
+            col.execute(fail)
+        # the worker keeps going
+        self.assertEqual(col.execute(collection_info)[1], col.path)
+
+
+class WorkerTest(CollectionTestCase):
+    config = {
+        'collection_wrapper': 'test_process.FakeCollectionWrapper',
+        'collection_idle_timeout': '0',
+    }
+
+    def setUp(self):
+        super().setUp()
+        FakeCollectionWrapper.opened_paths.clear()
+        self.conn, worker_conn = Pipe()
+        self.worker = _Worker(self.config, worker_conn)
+        self.worker.monitor_frequency = 0.05
+
+    def call(self, path, func, args=[]):
+        buf = io.BytesIO()
+        _Pickler(buf).dump((("-", False), path, None, func, args, {}))
+        return self.worker._call(buf.getvalue())
+
+    def test_close_inactive(self):
+        path = self.path("a")
+        self.call(path, collection_info)
+        self.assertIn(path, self.worker.collection_manager.collections)
+
+        self.worker._close_inactive()
+        self.assertNotIn(path, self.worker.collection_manager.collections)
+
+    def test_report_closed(self):
+        paths = [self.path(name) for name in ("a", "b")]
+        for path in paths:
+            self.call(path, collection_info)
+        self.worker._close_inactive()
+
+        # the collection of the call itself has just been opened again
+        ret, closed = pickle.loads(self.call(paths[0], collection_info))
+        self.assertEqual(closed, [paths[1]])
+        ret, closed = pickle.loads(self.call(paths[0], collection_info))
+        self.assertEqual(closed, [])
+
+    def test_close_inactive_while_busy(self):
+        path = self.path("a")
+        thread = threading.Thread(target=self.worker.run)
+        thread.start()
+        try:
+            # more often than monitor_frequency
+            deadline = time.monotonic() + 0.5
+            while time.monotonic() < deadline:
+                buf = io.BytesIO()
+                _Pickler(buf).dump((("-", False), path, None, collection_info, [], {}))
+                self.conn.send_bytes(buf.getvalue())
+                self.conn.recv_bytes()
+                time.sleep(0.01)
+        finally:
+            self.conn.send_bytes(b"")
+            thread.join()
+
+        # closed by the monitor in between calls, and opened again
+        self.assertGreater(FakeCollectionWrapper.opened_paths.count(path), 1)
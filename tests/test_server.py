@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import time
+import unittest
+
+from ankisyncd.server import RequestHandler, ThreadPoolWSGIServer
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+    start_response("200 OK", [("Content-Length", str(len(body)))])
+    return [body]
+
+
+class ServerTestBase(unittest.TestCase):
+    keepalive_timeout = 0.2
+
+    def setUp(self):
+        self.httpd = ThreadPoolWSGIServer(("127.0.0.1", 0), RequestHandler,
+                                          workers=2, keepalive_timeout=self.keepalive_timeout)
+        self.httpd.set_app(echo_app)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={"poll_interval": 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.drain(5)
+
+    def connect(self):
+        sock = socket.create_connection(self.httpd.server_address)
+        self.addCleanup(sock.close)
+        return sock
+
+    def request(self, sock, body):
+        sock.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n\r\n%s"
+                     % (len(body), body))
+
+    def read_response(self, sock, body):
+        sock.settimeout(5)
+        response = b""
+        while not response.endswith(body):
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        return response
+
+
+class ThreadPoolWSGIServerTest(ServerTestBase):
+    def test_slow_request_body(self):
+        sock = self.connect()
+        sock.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 10\r\n\r\nhello")
+        # longer than the keep-alive timeout
+        time.sleep(0.5)
+        sock.sendall(b"world")
+
+        sock.settimeout(5)
+        response = b""
+        while not response.endswith(b"helloworld"):
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        self.assertTrue(response.startswith(b"HTTP/1.1 200"), response)
+        self.assertTrue(response.endswith(b"helloworld"), response)
+
+    def test_idle_connection_closed(self):
+        sock = self.connect()
+        sock.settimeout(5)
+        # closed after the keep-alive timeout without any request
+        self.assertEqual(sock.recv(1), b"")
+
+
+class KeepAliveTest(ServerTestBase):
+    keepalive_timeout = 30
+
+    def test_idle_connections_dont_hold_workers(self):
+        # as many idle persistent connections as there are workers
+        for body in (b"first", b"second"):
+            sock = self.connect()
+            self.request(sock, body)
+            self.assertTrue(self.read_response(sock, body).endswith(body))
+
+        start = time.time()
+        sock = self.connect()
+        self.request(sock, b"third")
+        self.assertTrue(self.read_response(sock, b"third").endswith(b"third"))
+        self.assertLess(time.time() - start, 5)
+
+    def test_pipelined_requests(self):
+        sock = self.connect()
+        sock.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nhello"
+                     b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nworld")
+        response = self.read_response(sock, b"world")
+        self.assertEqual(response.count(b"HTTP/1.1 200"), 2, response)
+
+    def test_drain_closes_idle_connections(self):
+        sock = self.connect()
+        self.request(sock, b"hello")
+        self.read_response(sock, b"hello")
+
+        self.httpd.drain(5)
+        self.assertEqual(sock.recv(1), b"")
@@ -3,6 +3,8 @@
 import os
 import tempfile
 import sqlite3
+import threading
+import time
 import unittest
 import configparser
 
@@ -92,6 +94,30 @@ class SimpleSessionManagerTest(unittest.TestCase):
         self.assertEqual(loaded_session.name, self.test_session.name)
         self.assertEqual(loaded_session.path, self.test_session.path)
 
+    def test_load_from_skey(self):
+        self.sessionManager.save(self.test_hkey, self.test_session)
+
+        loaded_session = self.sessionManager.load_from_skey(self.test_session.skey)
+        self.assertEqual(loaded_session.name, self.test_session.name)
+        self.assertIsNone(self.sessionManager.load_from_skey('nonexistent'))
+
+    def test_load_from_skey_after_change(self):
+        session = SyncUserSession('testName', self.sdir, None, None)
+        old_skey = session.skey
+        self.sessionManager.save(self.test_hkey, session)
+
+        session.skey = 'newskey0'
+        self.sessionManager.save(self.test_hkey, session)
+
+        self.assertIs(self.sessionManager.load_from_skey('newskey0'), session)
+        self.assertIsNone(self.sessionManager.load_from_skey(old_skey))
+
+    def test_load_from_skey_after_delete(self):
+        self.sessionManager.save(self.test_hkey, self.test_session)
+        self.sessionManager.delete(self.test_hkey)
+
+        self.assertIsNone(self.sessionManager.load_from_skey(self.test_session.skey))
+
 
 class SqliteSessionManagerTest(SimpleSessionManagerTest):
     file_descriptor, _test_sess_db_path = tempfile.mkstemp(suffix=".db")
@@ -119,5 +145,143 @@ class SqliteSessionManagerTest(SimpleSessionManagerTest):
         self.assertEqual(res[0], self.test_session.name)
         self.assertEqual(res[1], self.test_session.path)
 
+    def test_load_from_skey_from_db(self):
+        SimpleSessionManagerTest.test_save(self)
+
+        # a new manager only knows about the session from the database
+        sessionManager = SqliteSessionManager(self._test_sess_db_path)
+        factory = lambda username, path: SyncUserSession(username, path, None, None)
+        loaded_session = sessionManager.load_from_skey(self.test_session.skey, factory)
+        self.assertEqual(loaded_session.name, self.test_session.name)
+        self.assertEqual(loaded_session.skey, self.test_session.skey)
+        self.assertIs(sessionManager.load(self.test_hkey), loaded_session)
+
+    def test_skey_index(self):
+        SimpleSessionManagerTest.test_save(self)
 
+        conn = sqlite3.connect(self._test_sess_db_path)
+        cursor = conn.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN SELECT hkey FROM session WHERE skey=?",
+                       (self.test_session.skey,))
+        plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+        conn.close()
 
+        self.assertIn("ix_session_skey", plan)
+
+    def test_flush_interval(self):
+        sessionManager = SqliteSessionManager(self._test_sess_db_path, flush_interval=60)
+        sessionManager.save(self.test_hkey, self.test_session)
+
+        def count_rows():
+            if not os.path.exists(self._test_sess_db_path):
+                return 0
+            conn = sqlite3.connect(self._test_sess_db_path)
+            res = conn.execute("SELECT count() FROM session").fetchone()[0]
+            conn.close()
+            return res
+
+        # not written yet, but the session is available
+        self.assertEqual(count_rows(), 0)
+        self.assertIs(sessionManager.load(self.test_hkey), self.test_session)
+
+        sessionManager.flush()
+        self.assertEqual(count_rows(), 1)
+
+        # deleted sessions mustn't be loaded from the database before the
+        # deletion is written
+        sessionManager.delete(self.test_hkey)
+        factory = lambda username, path: SyncUserSession(username, path, None, None)
+        self.assertIsNone(sessionManager.load(self.test_hkey, factory))
+        self.assertIsNone(sessionManager.load_from_skey(self.test_session.skey, factory))
+
+        sessionManager.flush()
+        self.assertEqual(count_rows(), 0)
+
+    def test_load_from_skey_before_flush(self):
+        sessionManager = SqliteSessionManager(self._test_sess_db_path, flush_interval=60)
+        session = SyncUserSession('testName', self.sdir, None, None)
+        old_skey = session.skey
+        sessionManager.save(self.test_hkey, session)
+        sessionManager.flush()
+
+        # the database still has the old skey
+        session.skey = 'newskey0'
+        sessionManager.save(self.test_hkey, session)
+
+        factory = lambda username, path: SyncUserSession(username, path, None, None)
+        self.assertIsNone(sessionManager.load_from_skey(old_skey, factory))
+        self.assertIs(sessionManager.load(self.test_hkey), session)
+        self.assertIs(sessionManager.load_from_skey('newskey0'), session)
+
+    def count_rows(self):
+        conn = sqlite3.connect(self._test_sess_db_path)
+        res = conn.execute("SELECT count() FROM session").fetchone()[0]
+        conn.close()
+        return res
+
+    def test_flusher_thread(self):
+        sessionManager = SqliteSessionManager(self._test_sess_db_path, flush_interval=0.05)
+
+        def wait_for_flush():
+            for _ in range(100):
+                if not sessionManager._pending and not sessionManager._flushing:
+                    break
+                time.sleep(0.05)
+
+        sessionManager.save(self.test_hkey, self.test_session)
+        flusher = sessionManager._flusher
+        wait_for_flush()
+        self.assertEqual(self.count_rows(), 1)
+
+        sessionManager.delete(self.test_hkey)
+        wait_for_flush()
+        self.assertEqual(self.count_rows(), 0)
+
+        # the same thread writes all the delayed changes
+        self.assertIs(sessionManager._flusher, flusher)
+        sessionManager.close()
+        self.assertFalse(flusher.is_alive())
+
+    def test_load_during_flush(self):
+        committing = threading.Event()
+        resume = threading.Event()
+
+        class SlowConnection:
+            def __init__(self, conn):
+                self.conn = conn
+
+            def cursor(self):
+                return self.conn.cursor()
+
+            def commit(self):
+                committing.set()
+                resume.wait(5)
+                self.conn.commit()
+
+        class SlowSessionManager(SqliteSessionManager):
+            def _connect(self):
+                return SlowConnection(SqliteSessionManager._connect(self))
+
+        sessionManager = SlowSessionManager(self._test_sess_db_path, flush_interval=60)
+        sessionManager.save(self.test_hkey, self.test_session)
+        resume.set()
+        sessionManager.flush()
+        self.assertEqual(self.count_rows(), 1)
+
+        committing.clear()
+        resume.clear()
+        sessionManager.delete(self.test_hkey)
+        flush = threading.Thread(target=sessionManager.flush)
+        flush.start()
+        try:
+            self.assertTrue(committing.wait(5))
+            # neither blocked by the commit nor reading the deleted session
+            start = time.time()
+            factory = lambda username, path: SyncUserSession(username, path, None, None)
+            self.assertIsNone(sessionManager.load(self.test_hkey, factory))
+            self.assertIsNone(sessionManager.load_from_skey(self.test_session.skey, factory))
+            self.assertLess(time.time() - start, 1)
+        finally:
+            resume.set()
+            flush.join()
+        self.assertEqual(self.count_rows(), 0)
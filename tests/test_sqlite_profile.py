@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from anki.db import DB
+
+from ankisyncd.sqlite_profile import SqliteProfile
+
+
+class SqliteProfileTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.db = DB(self.path)
+        self.db.execute("CREATE TABLE t (x INT)")
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+
+    def test_config(self):
+        self.assertEqual(SqliteProfile().pragmas, {})
+
+        profile = SqliteProfile({'sqlite_profile': 'wal', 'sqlite_synchronous': 'full'})
+        self.assertTrue(profile.wal)
+        self.assertEqual(profile.pragmas['synchronous'], 'full')
+
+        with self.assertRaises(ValueError):
+            SqliteProfile({'sqlite_profile': 'fast'})
+        with self.assertRaises(ValueError):
+            SqliteProfile({'sqlite_cache_size': '1; drop table t'})
+
+    def test_apply(self):
+        # inside a transaction, as collections opened by Anki are
+        self.db.execute("INSERT INTO t VALUES (1)")
+        SqliteProfile({'sqlite_profile': 'wal'}).apply(self.db)
+
+        self.assertEqual(self.db.scalar("pragma journal_mode"), "wal")
+        self.assertEqual(self.db.scalar("pragma synchronous"), 1)
+        self.assertEqual(self.db.scalar("pragma temp_store"), 2)
+        self.assertEqual(self.db.scalar("SELECT count() FROM t"), 1)
+
+    def test_checkpoint(self):
+        profile = SqliteProfile({'sqlite_profile': 'wal'})
+        profile.apply(self.db)
+        self.db.execute("INSERT INTO t VALUES (1)")
+        self.db.commit()
+        self.assertGreater(os.path.getsize(self.path + "-wal"), 0)
+
+        profile.checkpoint(self.db)
+        self.assertEqual(os.path.getsize(self.path + "-wal"), 0)
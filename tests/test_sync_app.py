@@ -1,15 +1,32 @@
 # -*- coding: utf-8 -*-
+import configparser
+import io
+import json
 import os
+import shutil
 import sqlite3
+import sys
 import tempfile
+import threading
+import types
 import unittest
+import zipfile
+from unittest.mock import MagicMock, patch
 
+import anki.utils
 from anki.consts import SYNC_VER
+from webob.exc import HTTPConflict
 
+import ankisyncd.media
+import ankisyncd.sync_app
+from ankisyncd.media_cache import MediaBlobCache
+from ankisyncd.sync_app import HandlerMethodCall
 from ankisyncd.sync_app import SyncCollectionHandler
+from ankisyncd.sync_app import SyncMediaHandler
 from ankisyncd.sync_app import SyncUserSession
 
 from collection_test_base import CollectionTestBase
+import helpers.server_utils
 
 
 class SyncCollectionHandlerTest(CollectionTestBase):
@@ -64,6 +81,253 @@ class SyncCollectionHandlerTest(CollectionTestBase):
         self.assertEqual(meta['msg'], '')
         self.assertEqual(meta['cont'], True)
 
+    def test_read_only_operations(self):
+        saves = []
+        self.collection.save = lambda *args, **kw: saves.append(args)
+        session = types.SimpleNamespace(
+            get_handler_for_operation=lambda operation, col: self.syncCollectionHandler)
+
+        HandlerMethodCall('meta', session)(self.collection, v=SYNC_VER)
+        self.assertEqual(saves, [])
+
+        graves = {"cards": [], "notes": [], "decks": []}
+        HandlerMethodCall('applyGraves', session)(self.collection, chunk=graves)
+        self.assertEqual(len(saves), 1)
+
+        # another session's sync is committed by its own finish
+        self.collection.sync_transaction = object()
+        HandlerMethodCall('applyGraves', session)(self.collection, chunk=graves)
+        self.assertEqual(len(saves), 1)
+        self.collection.sync_transaction = None
+
+    def test_sync_transaction(self):
+        handler = SyncCollectionHandler(self.collection, {'sync_transaction_timeout': '60'})
+        graves = {"cards": [], "notes": [], "decks": []}
+        self.collection.save()
+
+        handler.start(minUsn=0, lnewer=False, graves=graves)
+        self.assertTrue(handler.in_transaction())
+        self.assertFalse(handler.needs_save('applyGraves'))
+        self.add_default_note()
+
+        handler.abort()
+        self.assertFalse(handler.in_transaction())
+        self.assertEqual(self.collection.noteCount(), 0)
+        # the rest of the aborted sync is refused
+        with self.assertRaises(HTTPConflict):
+            handler.applyGraves(chunk=graves)
+
+
+class SyncMediaHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        # all the media handler needs of a collection
+        self.col = types.SimpleNamespace(
+            path=os.path.join(self.temp_dir, "collection.anki2"))
+        os.mkdir(os.path.join(self.temp_dir, "collection.media"))
+        self.col.media = ankisyncd.media.ServerMediaManager(self.col)
+        self.addCleanup(self.col.media.close)
+
+    def add_file(self, fname, data):
+        with open(os.path.join(self.col.media.dir(), fname), "wb") as f:
+            f.write(data)
+        self.col.media.syncAdd([(fname, anki.utils.checksum(data))])
+        self.col.media.db.commit()
+
+    def upload_zip(self, files, removed=()):
+        buf = io.BytesIO()
+        meta = []
+        with zipfile.ZipFile(buf, "w") as z:
+            for i, (fname, data) in enumerate(files.items()):
+                z.writestr(str(i), data)
+                meta.append([fname, str(i)])
+            meta.extend([fname, None] for fname in removed)
+            z.writestr("_meta", json.dumps(meta))
+        return buf.getvalue()
+
+    def test_uploadChanges_parallel(self):
+        self.add_file("old.txt", b"old")
+        self.add_file("removed.txt", b"removed")
+        old_usn = self.col.media.lastUsn()
+
+        files = {"file%d.txt" % i: os.urandom(1000) for i in range(6)}
+        handler = SyncMediaHandler(self.col, {"media_upload_workers": "3"})
+
+        # files are saved by two threads at a time at least
+        barrier = threading.Barrier(2, timeout=5)
+        save = handler._save_zip_member
+        def save_in_parallel(*args):
+            barrier.wait()
+            return save(*args)
+        handler._save_zip_member = save_in_parallel
+
+        commits = []
+        commit = self.col.media.db.commit
+        def count_commit():
+            commits.append(True)
+            commit()
+        self.col.media.db.commit = count_commit
+
+        res = handler.uploadChanges(self.upload_zip(files, ["removed.txt"]))
+        self.assertEqual(res["data"], [7, old_usn + 7])
+
+        for fname, data in files.items():
+            with open(os.path.join(self.col.media.dir(), fname), "rb") as f:
+                self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(os.path.join(self.col.media.dir(), "removed.txt")))
+        # no temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.col.media.dir())), sorted(files) + ["old.txt"])
+
+        # the added files get consecutive USNs in the order of the zip, and
+        # are committed at once, after the removals
+        rows = self.col.media.db.all(
+            "SELECT fname, usn, csum FROM media WHERE usn > ? ORDER BY usn", old_usn)
+        self.assertEqual(rows, [("removed.txt", old_usn + 1, None)] + [
+            (fname, old_usn + 2 + i, anki.utils.checksum(data))
+            for i, (fname, data) in enumerate(files.items())])
+        self.assertEqual(len(commits), 2)
+
+    def test_uploadChanges_parallel_error(self):
+        old_usn = self.col.media.lastUsn()
+        files = {"file%d.txt" % i: os.urandom(1000) for i in range(4)}
+        handler = SyncMediaHandler(self.col, {"media_upload_workers": "2"})
+
+        save = handler._save_zip_member
+        def fail_one(zip_file, zip_info, filename):
+            if filename == "file2.txt":
+                raise OSError("disk full")
+            return save(zip_file, zip_info, filename)
+        handler._save_zip_member = fail_one
+
+        with self.assertRaises(OSError):
+            handler.uploadChanges(self.upload_zip(files))
+        # nothing is recorded
+        self.assertEqual(self.col.media.lastUsn(), old_usn)
+        self.assertEqual(self.col.media.db.scalar("SELECT count() FROM media"), 0)
+
+    def test_uploadChanges_failed_commit(self):
+        self.add_file("old.txt", b"old")
+        old_usn = self.col.media.lastUsn()
+        handler = SyncMediaHandler(self.col)
+
+        commit = self.col.media.db.commit
+        def fail_commit():
+            raise sqlite3.OperationalError("disk I/O error")
+        self.col.media.db.commit = fail_commit
+        with self.assertRaises(sqlite3.OperationalError):
+            handler.uploadChanges(self.upload_zip({"a.txt": b"a", "b.txt": b"b"}))
+        self.assertEqual(self.col.media.lastUsn(), old_usn)
+
+        # the next upload doesn't leave a gap
+        self.col.media.db.commit = commit
+        res = handler.uploadChanges(self.upload_zip({"a.txt": b"a"}))
+        self.assertEqual(res["data"], [1, old_usn + 1])
+        self.assertEqual(self.col.media.db.scalar(
+            "SELECT usn FROM media WHERE fname = 'a.txt'"), old_usn + 1)
+
+    def download(self, handler, fnames):
+        response = handler.downloadFiles(fnames)
+        try:
+            data = b"".join(response.app_iter)
+        finally:
+            response.app_iter.close()
+        z = zipfile.ZipFile(io.BytesIO(data))
+        self.addCleanup(z.close)
+        self.assertIsNone(z.testzip())
+        meta = json.loads(z.read("_meta").decode())
+        return z, {fname: z.read(name) for name, fname in meta.items()}
+
+    def test_downloadFiles(self):
+        files = {"a.txt": b"hello " * 1000, "b.txt": b"world " * 1000}
+        for fname, data in files.items():
+            self.add_file(fname, data)
+
+        z, downloaded = self.download(SyncMediaHandler(self.col), list(files))
+        self.assertEqual(downloaded, files)
+
+    def test_downloadFiles_compress_type(self):
+        with open(os.path.join(os.path.dirname(__file__), "assets", "blue.jpg"), "rb") as f:
+            image = f.read()
+        files = {
+            "blue.jpg": image,
+            # sniffed, despite the extension
+            "image.dat": image,
+            "sound.mp3": b"ID3\x04\x00" + os.urandom(1000),
+            "text.txt": b"hello " * 1000,
+            "other.dat": b"\x00" * 1000,
+        }
+        for fname, data in files.items():
+            self.add_file(fname, data)
+
+        z, downloaded = self.download(SyncMediaHandler(self.col), list(files))
+        self.assertEqual(downloaded, files)
+        meta = json.loads(z.read("_meta").decode())
+        compress_types = {meta[info.filename]: info.compress_type
+                          for info in z.infolist() if info.filename != "_meta"}
+        self.assertEqual(compress_types, {
+            "blue.jpg": zipfile.ZIP_STORED,
+            "image.dat": zipfile.ZIP_STORED,
+            "sound.mp3": zipfile.ZIP_STORED,
+            "text.txt": zipfile.ZIP_DEFLATED,
+            "other.dat": zipfile.ZIP_DEFLATED,
+        })
+
+        # with compression turned off, everything is stored
+        z, downloaded = self.download(
+            SyncMediaHandler(self.col, {"media_compression_level": "0"}), ["text.txt"])
+        self.assertEqual([info.compress_type for info in z.infolist()
+                          if info.filename != "_meta"], [zipfile.ZIP_STORED])
+
+    def test_downloadFiles_cached(self):
+        data = b"hello " * 1000
+        self.add_file("a.txt", data)
+        handler = SyncMediaHandler(self.col)
+        handler.cache = MediaBlobCache(os.path.join(self.temp_dir, "cache"), 1024 * 1024)
+
+        # deflated into the cache the first time, spliced in from it afterwards
+        for _ in range(2):
+            z, downloaded = self.download(handler, ["a.txt"])
+            self.assertEqual(downloaded, {"a.txt": data})
+        self.assertEqual(list(handler.cache._entries), [anki.utils.checksum(data)])
+
+    def test_downloadFiles_not_sent(self):
+        self.add_file("a.txt", b"hello")
+        opened = []
+        real_open = open
+
+        def tracking_open(*args, **kw):
+            f = real_open(*args, **kw)
+            opened.append(f)
+            return f
+
+        with patch("builtins.open", tracking_open):
+            response = SyncMediaHandler(self.col).downloadFiles(["a.txt"])
+        # the client went away before the response was started
+        response.app_iter.close()
+        self.assertTrue(opened)
+        self.assertTrue(all(f.closed for f in opened))
+
 
 class SyncAppTest(unittest.TestCase):
-    pass
+    def test_main(self):
+        server_paths = helpers.server_utils.create_server_paths()
+        config = configparser.ConfigParser()
+        config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 "assets", "test.conf"))
+        config['sync_app'].update(server_paths)
+        config_path = os.path.join(os.path.dirname(server_paths['data_root']), "ankisyncd.conf")
+        with open(config_path, "w") as f:
+            config.write(f)
+
+        # the server stops right away, as if interrupted
+        httpd = MagicMock(server_address=("127.0.0.1", 27701))
+        httpd.serve_forever.side_effect = KeyboardInterrupt
+        with patch.object(sys, "argv", ["ankisyncd", config_path]), \
+                patch("ankisyncd.server.make_server", return_value=httpd) as make_server, \
+                patch("signal.signal"):
+            ankisyncd.sync_app.main()
+
+        make_server.assert_called_once()
+        httpd.serve_forever.assert_called_once_with()
+        httpd.drain.assert_called_once_with(30.0)
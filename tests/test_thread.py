@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import types
+import unittest
+from threading import current_thread
+from unittest.mock import patch
+
+from ankisyncd.collection import CollectionWrapper
+from ankisyncd.thread import ThreadingCollectionManager
+
+
+class FakeCollection:
+    def __init__(self, path):
+        self.path = path
+        self.db = object()
+
+    def close(self, save=True):
+        self.db = None
+
+class FakeCollectionWrapper(CollectionWrapper):
+    def _get_collection(self):
+        return FakeCollection(self.path)
+
+
+def collection_path(col):
+    return col.path
+
+
+class ThreadingCollectionManagerTest(unittest.TestCase):
+    config = {
+        'collection_wrapper': 'test_thread.FakeCollectionWrapper',
+        'collection_max_open': '2',
+    }
+
+    def setUp(self):
+        self.data_root = tempfile.mkdtemp(prefix="ankisyncd-thread-")
+        self.manager = ThreadingCollectionManager(self.config)
+
+    def tearDown(self):
+        self.manager.shutdown()
+        shutil.rmtree(self.data_root)
+
+    def path(self, name):
+        path = os.path.join(self.data_root, name, "collection.anki2")
+        os.makedirs(os.path.dirname(path))
+        open(path, "w").close()
+        return os.path.realpath(path)
+
+    def test_max_open(self):
+        self.manager.evict_min_idle = 0
+        paths = [self.path(name) for name in ("a", "b", "c")]
+        wrappers = []
+        for path in paths:
+            wrapper = self.manager.get_collection(path)
+            self.assertEqual(wrapper.execute(collection_path), path)
+            wrappers.append(wrapper)
+
+        # the least recently used one made room for the last one
+        self.assertTrue(wrappers[0].evicted)
+        self.assertEqual(len(self.manager._active()), 2)
+
+        # calls on an evicted wrapper go to the one replacing it
+        self.assertEqual(wrappers[0].execute(collection_path), paths[0])
+        self.assertIsNot(self.manager.get_collection(paths[0]), wrappers[0])
+        self.assertTrue(wrappers[1].evicted)
+
+    def test_max_open_recently_used(self):
+        paths = [self.path(name) for name in ("a", "b", "c")]
+        wrappers = [self.manager.get_collection(path) for path in paths]
+        for wrapper in wrappers:
+            wrapper.execute(collection_path)
+
+        # the client may be about to make its next call
+        self.assertFalse(any(wrapper.evicted for wrapper in wrappers))
+        self.assertEqual(len(self.manager._active()), 3)
+
+    def test_max_open_syncing(self):
+        self.manager.evict_min_idle = 0
+        paths = [self.path(name) for name in ("a", "b", "c")]
+        wrappers = [self.manager.get_collection(path) for path in paths[:2]]
+        wrappers[0].execute(lambda col: setattr(col, "sync_handler", object()))
+        wrappers[1].execute(collection_path)
+
+        # the collection in the middle of a sync is skipped
+        self.manager.get_collection(paths[2]).execute(collection_path)
+        self.assertFalse(wrappers[0].evicted)
+        self.assertTrue(wrappers[1].evicted)
+
+    def test_memory_budget(self):
+        self.manager.max_open = 0
+        self.manager.evict_min_idle = 0
+        self.manager.memory_budget = 1
+        wrappers = [self.manager.get_collection(self.path(name)) for name in ("a", "b", "c")]
+        for wrapper in wrappers:
+            wrapper.execute(collection_path)
+
+        # the RSS doesn't go down, only one collection is closed per round
+        with patch("ankisyncd.thread.current_rss", return_value=2):
+            with self.manager._lock:
+                self.manager._enforce_memory_budget()
+            self.assertEqual([wrapper.evicted for wrapper in wrappers], [True, False, False])
+            with self.manager._lock:
+                self.manager._enforce_memory_budget()
+            self.assertEqual([wrapper.evicted for wrapper in wrappers], [True, True, False])
+
+    def test_evict_idle(self):
+        wrapper = self.manager.get_collection(self.path("a"))
+        wrapper.execute(collection_path)
+
+        self.assertFalse(wrapper.evict(min_idle=60))
+        self.assertTrue(wrapper.evict())
+        wrapper.join()
+        self.assertFalse(wrapper.alive())
+        self.assertFalse(wrapper.opened())
+
+    def test_sync_in_progress(self):
+        wrapper = self.manager.get_collection(self.path("a"))
+        sync = types.SimpleNamespace(expired=lambda: False)
+        wrapper.execute(lambda col: setattr(col, "sync_transaction", sync))
+
+        self.assertFalse(wrapper.evict())
+        self.assertFalse(wrapper.evict(keep_syncing=True))
+        # a sync which has timed out doesn't keep the collection open
+        sync.expired = lambda: True
+        self.assertTrue(wrapper.evict())
+
+    def test_replace(self):
+        path = self.path("a")
+        wrapper = self.manager.get_collection(path)
+        wrapper.execute(collection_path)
+
+        with open(path + ".tmp", "w") as f:
+            f.write("uploaded")
+        wrapper.replace(path + ".tmp")
+        self.assertFalse(wrapper.opened())
+        with open(path) as f:
+            self.assertEqual(f.read(), "uploaded")
+
+    def test_checkpoint_idle(self):
+        wrapper = self.manager.get_collection(self.path("a"))
+        wrapper.execute(collection_path)
+        last_used = wrapper.last_timestamp
+
+        self.assertFalse(wrapper.checkpoint(min_idle=60))
+        self.assertTrue(wrapper.checkpoint())
+        # not used since the last checkpoint
+        self.assertFalse(wrapper.checkpoint())
+
+        while not wrapper.qempty():
+            time.sleep(0.01)
+        # checkpoints don't count as using the collection
+        self.assertEqual(wrapper.last_timestamp, last_used)
+        self.assertTrue(wrapper.evict())
+
+
+class SharedWorkersTest(ThreadingCollectionManagerTest):
+    config = dict(ThreadingCollectionManagerTest.config, collection_workers='2')
+
+    def test_workers(self):
+        paths = [self.path(name) for name in ("a", "b", "c")]
+        threads = {self.manager.get_collection(path).execute(lambda col: current_thread())
+                   for path in paths}
+        self.assertLessEqual(len(threads), 2)
+        self.assertLessEqual(threads, {worker._thread for worker in self.manager._workers})
@@ -208,3 +208,48 @@ class SqliteUserManagerTest(unittest.TestCase):
         self.assertTrue(self.user_manager.authenticate(username,
                                                        new_password))
 
+    def test_conn_override(self):
+        opened = []
+
+        class CountingUserManager(SqliteUserManager):
+            def _conn(self):
+                conn = SqliteUserManager._conn(self)
+                opened.append(conn)
+                return conn
+
+        user_manager = CountingUserManager(self.auth_db_path,
+                                           self.collection_path)
+        user_manager.create_auth_db()
+        user_manager.add_user("my_username", "my_password")
+        self.assertTrue(user_manager.user_exists("my_username"))
+        self.assertTrue(user_manager.authenticate("my_username", "my_password"))
+        self.assertEqual(user_manager.user_list(), ["my_username"])
+
+        # the connection _conn() returns is reused
+        self.assertEqual(len(opened), 1)
+        user_manager.close()
+
+    def test_authenticate_cached(self):
+        username = "my_username"
+        password = "my_password"
+
+        user_manager = SqliteUserManager(self.auth_db_path,
+                                         self.collection_path,
+                                         auth_cache_ttl=60)
+        user_manager.create_auth_db()
+        user_manager.add_user(username, password)
+        self.assertTrue(user_manager.authenticate(username, password))
+
+        # a cached login doesn't need the database
+        user_manager._cached_conn = None
+        self.assertTrue(user_manager.authenticate(username, password))
+        self.assertFalse(user_manager.authenticate(username, "wrong_password"))
+        del user_manager._cached_conn
+
+        # changing the password invalidates the cache
+        user_manager.set_password_for_user(username, "my_new_password")
+        self.assertFalse(user_manager.authenticate(username, password))
+        self.assertTrue(user_manager.authenticate(username, "my_new_password"))
+
+        user_manager.del_user(username)
+        self.assertFalse(user_manager.authenticate(username, "my_new_password"))